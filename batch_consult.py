@@ -0,0 +1,241 @@
+# 배치 상담 실행기
+#
+# 프롬프트를 바꿀 때마다 검토용 증상 사례(텍스트·이미지)를 UI 없이 한꺼번에 다시 돌려보기 위한 도구입니다.
+# streamlit_app.py의 메시지 구성 코드를 그대로 사용하므로 앱과 같은 요청이 만들어집니다.
+#
+# 입력 JSONL 한 줄 예시:
+#   {"id": "fever-01", "symptoms": "아이가 39도 열이 나요"}
+#   {"id": "rash-03", "symptoms": "팔에 발진이 생겼어요", "image": "images/rash-03.jpg"}
+#   {"id": "rash-04", "image": "images/rash-04.jpg", "mode": "image"}
+#   {"id": "burn-02", "symptoms": "화상 부위가 어제보다 붉어졌어요", "images": ["images/burn-02a.jpg", "images/burn-02b.jpg"]}
+#
+# 실행 예시:
+#   $ python batch_consult.py cases.jsonl -o results.jsonl --workers 8 --rpm 300 --tpm 200000
+#   $ python batch_consult.py cases.jsonl --base-url http://127.0.0.1:8000/v1   # 로컬 목 서버 사용
+#   $ METRICS_FILE=batch.prom python batch_consult.py cases.jsonl                 # 지연시간·토큰·비용 지표 저장
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from openai import OpenAI, Timeout
+
+from streamlit_app import (
+    IMAGE_SYSTEM_PROMPT,
+    OPENAI_CONNECT_TIMEOUT,
+    OPENAI_TIMEOUT,
+    PRIORITY_NORMAL,
+    SYSTEM_PROMPT,
+    MetricsStore,
+    RequestScheduler,
+    build_advice_messages,
+    build_image_messages,
+    cached_prompt_ratio,
+    call_with_retries,
+    count_message_tokens,
+    encode_images,
+    record_completion,
+    refund_unused_tokens,
+    route_request,
+    total_image_tokens,
+    write_metrics_file,
+)
+
+
+# 입력 사례 읽기 (한 줄씩 스트리밍)
+def read_cases(path):
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            case = json.loads(line)
+            case.setdefault("id", f"line-{line_number}")
+            yield case
+
+
+# 이미 성공한 사례 id 읽기 (이어하기용)
+def completed_case_ids(output_path):
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 중간에 끊겨 반쯤 쓰인 마지막 줄은 무시하고 다시 실행
+                continue
+            if not record.get("error"):
+                done.add(record["id"])
+    return done
+
+
+# 결과 파일 정리 (이어하기로 다시 실행한 사례는 마지막 결과만 남김)
+def compact_results(output_path):
+    """같은 id가 여러 줄이면 마지막 줄만 처음 나온 순서대로 남기고, 지운 줄 수 반환"""
+    records, lines = {}, 0
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            lines += 1
+            try:
+                records[json.loads(line)["id"]] = line.rstrip("\n") + "\n"
+            except json.JSONDecodeError:
+                # 중간에 끊겨 반쯤 쓰인 줄은 버림
+                continue
+    removed = lines - len(records)
+    if removed:
+        temp_path = f"{output_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.writelines(records.values())
+        os.replace(temp_path, output_path)
+    return removed
+
+
+# 사례의 사진 경로 목록 (image 한 장 또는 images 여러 장)
+def case_image_paths(case):
+    return case.get("images") or ([case["image"]] if case.get("image") else [])
+
+# 사례 하나를 앱과 같은 방식의 요청으로 변환
+def build_request(case, base_dir, metrics=None, model=None):
+    """(요청 인자, 예상 프롬프트 토큰, 시스템 프롬프트, 선택된 규칙) 반환 (앱과 같은 규칙으로 모델·답변 길이 선택)"""
+    encoded_images = encode_images([(base_dir / path).read_bytes() for path in case_image_paths(case)], metrics)
+    image_tokens = total_image_tokens(encoded_images)
+    mode = case.get("mode") or ("image" if encoded_images and not case.get("symptoms", "").strip() else "advice")
+
+    if mode == "image":
+        if not encoded_images:
+            raise ValueError("이미지 분석 사례에는 image 또는 images 경로가 필요합니다.")
+        route, settings = route_request("image", image_count=len(encoded_images), override=model)
+        messages = build_image_messages(encoded_images)
+        return {"messages": messages, **settings}, count_message_tokens(messages, image_tokens), IMAGE_SYSTEM_PROMPT, route
+
+    route, settings = route_request("advice", case.get("symptoms", ""), len(encoded_images), override=model)
+    messages = build_advice_messages(case.get("symptoms", ""), encoded_images)
+    return {"messages": messages, **settings}, count_message_tokens(messages, image_tokens), SYSTEM_PROMPT, route
+
+
+# 사례 하나 실행 (재시도 포함)
+def run_case(client, case, base_dir, scheduler, max_retries, metrics, model=None):
+    started = time.perf_counter()
+    record = {"id": case["id"], "symptoms": case.get("symptoms", ""), "images": case_image_paths(case)}
+    try:
+        request, prompt_tokens, system_prompt, route = build_request(case, base_dir, metrics, model)
+    except Exception as e:
+        return {**record, "error": f"요청 구성 실패: {e}"}
+    record["model"] = request["model"]
+    record["route"] = route["name"]
+    record["system_prompt_sha256"] = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:16]
+
+    reserved = prompt_tokens + request["max_tokens"]
+    admitted = None
+
+    def create():
+        nonlocal admitted
+        admitted = time.perf_counter()
+        return client.chat.completions.create(**request)
+
+    try:
+        response = call_with_retries(scheduler, create, reserved, PRIORITY_NORMAL, max_retries=max_retries, metrics=metrics)
+    except Exception as e:
+        metrics.increment("chatbot_requests_total", model=request["model"], route=route["name"], outcome="error")
+        return {**record, "error": f"{type(e).__name__}: {e}"}
+    refund_unused_tokens(scheduler, reserved, response.usage)
+    finish_reason = response.choices[0].finish_reason
+    record_completion(
+        metrics, request["model"], time.perf_counter() - admitted, usage=response.usage,
+        outcome="truncated" if finish_reason == "length" else "ok", route=route["name"]
+    )
+    return {
+        **record,
+        "content": response.choices[0].message.content,
+        "finish_reason": finish_reason,
+        "usage": response.usage.model_dump() if response.usage is not None else None,
+        "cached_ratio": cached_prompt_ratio(response.usage),
+        "latency": round(time.perf_counter() - started, 3),
+        "error": None
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="증상 사례 JSONL을 앱과 같은 프롬프트로 일괄 상담합니다.")
+    parser.add_argument("cases", help="입력 사례 JSONL 파일")
+    parser.add_argument("-o", "--output", help="결과 JSONL 파일 (기본값: <입력 파일 이름>.results.jsonl)")
+    parser.add_argument("--workers", type=int, default=4, help="동시에 보낼 요청 수")
+    parser.add_argument("--rpm", type=int, default=60, help="분당 최대 요청 수 (0이면 제한 없음)")
+    parser.add_argument("--tpm", type=int, default=60000, help="분당 최대 토큰 수 (0이면 제한 없음)")
+    parser.add_argument("--max-retries", type=int, default=5, help="일시적 오류 재시도 횟수 (429는 Retry-After를 따름)")
+    parser.add_argument("--model", help="규칙과 관계없이 이 모델로 고정 (기본값: 앱과 같은 자동 선택)")
+    parser.add_argument("--base-url", default=os.getenv("OPENAI_BASE_URL"), help="OpenAI 호환 서버 주소 (로컬 목 서버 등)")
+    parser.add_argument("--api-key", default=os.getenv("OPENAI_API_KEY"), help="API 키 (기본값: OPENAI_API_KEY 환경 변수)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.api_key:
+        sys.exit("API 키가 필요합니다. --api-key 또는 OPENAI_API_KEY 환경 변수를 지정하세요.")
+    cases_path = Path(args.cases)
+    output_path = args.output or str(cases_path.with_suffix(".results.jsonl"))
+
+    client = OpenAI(
+        api_key=args.api_key,
+        base_url=args.base_url,
+        timeout=Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+        # 재시도는 스케줄러가 Retry-After에 맞춰 처리하므로 클라이언트 자체 재시도는 끔
+        max_retries=0
+    )
+    # 앱과 같은 스케줄러로 분당 한도와 우선순위 대기열을 처리 (대기 작업은 작업자 수를 넘지 않음)
+    scheduler = RequestScheduler(args.rpm, args.tpm, max_queue=args.workers * 2)
+    metrics = MetricsStore()
+    done = completed_case_ids(output_path)
+    if done:
+        print(f"이미 완료된 사례 {len(done)}건은 건너뜁니다.", file=sys.stderr)
+
+    counts = {"ok": 0, "failed": 0, "skipped": 0}
+    started = time.perf_counter()
+    with open(output_path, "a", encoding="utf-8") as output, ThreadPoolExecutor(max_workers=args.workers) as executor:
+        in_flight = set()
+
+        def write_finished(finished):
+            for future in finished:
+                record = future.result()
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+                counts["failed" if record.get("error") else "ok"] += 1
+            elapsed = time.perf_counter() - started
+            processed = counts["ok"] + counts["failed"]
+            print(
+                f"\r완료 {counts['ok']} · 실패 {counts['failed']} · 건너뜀 {counts['skipped']} · "
+                f"{processed / elapsed * 60:.1f}건/분",
+                end="", file=sys.stderr, flush=True
+            )
+
+        for case in read_cases(cases_path):
+            if case["id"] in done:
+                counts["skipped"] += 1
+                continue
+            # 입력 전체를 메모리에 올리지 않도록 진행 중 작업 수를 작업자 수의 두 배로 제한
+            if len(in_flight) >= args.workers * 2:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                write_finished(finished)
+            in_flight.add(executor.submit(run_case, client, case, cases_path.parent, scheduler, args.max_retries, metrics, args.model))
+        while in_flight:
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            write_finished(finished)
+
+    write_metrics_file(metrics, force=True)
+    removed = compact_results(output_path)
+    if removed:
+        print(f"\n다시 실행한 사례의 이전 결과 {removed}줄을 정리했습니다.", file=sys.stderr, end="")
+    print(f"\n결과: {output_path}", file=sys.stderr)
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,241 @@
+# 상담 요청마다 실행되는 코드의 마이크로벤치마크
+#
+# 사진 전처리·인코딩, 상담 메시지 구성, 로딩 바·상담 기록 HTML 생성, 이메일 복사 본문, 비전 요청 JSON 직렬화를
+# 호출당 시간(중앙값)과 tracemalloc 최대 메모리로 재고 hot_path_baseline.json의 기준값과 비교합니다.
+# 사진 인코딩은 전처리가 끝난 뒤(base64·data URL 단계)의 최대 메모리도 따로 잽니다.
+# 시간이 기준의 --time-tolerance배를 넘거나, 메모리가 기준보다 사진 data URL 길이의 절반 이상
+# (사진이 없는 항목은 --memory-tolerance배) 늘거나,
+# 상담 기록 HTML 생성 시간이 메시지 수에 비례하지 않고 더 빠르게 늘면 0이 아닌 코드로 종료합니다.
+# 시간 기준은 측정한 기기에 따라 다르므로 기기를 바꾸면 --update-baseline으로 다시 저장합니다.
+#
+# 실행 예시:
+#   $ python benchmarks/bench_hot_path.py
+#   $ python benchmarks/bench_hot_path.py --filter encode --repeat 9
+#   $ python benchmarks/bench_hot_path.py --update-baseline
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("CONSULT_DB", "")
+
+import streamlit as st  # noqa: E402
+from streamlit.logger import set_log_level  # noqa: E402
+
+import streamlit_app  # noqa: E402
+from streamlit_app import (  # noqa: E402
+    build_advice_messages,
+    build_context_messages,
+    build_image_messages,
+    copy_box_text,
+    encode_image_bytes,
+    render_message_html,
+    show_loading_bar,
+)
+
+set_log_level("error")
+
+BASELINE_PATH = Path(__file__).with_name("hot_path_baseline.json")
+HISTORY_SIZES = (10, 100, 1000)
+# 메시지 수가 100배일 때 메시지당 생성 시간이 이 배수보다 커지면 선형이 아닌 것으로 봄
+MAX_HISTORY_SCALING = 3.0
+
+# 한 번 측정에 쓰는 최소 시간 (짧은 함수는 여러 번 불러 합산)
+MIN_SAMPLE_SECONDS = 0.02
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="상담 요청 경로의 함수별 시간·메모리를 기준값과 비교합니다.")
+    parser.add_argument("--repeat", type=int, default=5, help="측정 반복 횟수 (중앙값 사용)")
+    parser.add_argument("--filter", default="", help="이름에 이 문자열이 들어간 항목만 측정")
+    parser.add_argument("--time-tolerance", type=float, default=2.0, help="기준 대비 허용 시간 배수")
+    parser.add_argument("--memory-tolerance", type=float, default=1.3, help="사진이 없는 항목의 기준 대비 허용 메모리 배수 (64KiB 여유 포함)")
+    parser.add_argument("--update-baseline", action="store_true", help="이번 측정값을 기준으로 저장")
+    return parser.parse_args(argv)
+
+
+# 같은 내용의 사진 (실행마다 같은 크기·압축률이 되도록 고정된 난수 사용)
+def make_photo(edge, image_format):
+    import numpy as np
+    from PIL import Image
+
+    height = edge * 3 // 4
+    noise = np.random.RandomState(edge).randint(0, 64, (height, edge, 3), dtype=np.uint8)
+    gradient = np.linspace(0, 191, edge, dtype=np.uint8)[None, :, None]
+    image = Image.fromarray(noise + gradient)
+    buffer = BytesIO()
+    image.save(buffer, image_format, **({"quality": 90} if image_format == "JPEG" else {}))
+    return buffer.getvalue()
+
+
+# 상담 기록 (부모님 질문과 챗봇 답변이 번갈아 나옴)
+def make_history(size):
+    answer = "🔍 가능한 원인: 감기일 가능성이 높습니다.<br>🏠 가정에서의 대처: 수분을 충분히 섭취하게 해주세요.<br>" * 8
+    return [
+        {"role": "user" if seq % 2 == 0 else "bot", "content": f"아이가 {seq}일째 기침을 해요" if seq % 2 == 0 else answer,
+         "id": f"{'user' if seq % 2 == 0 else 'bot'}_{seq}", "seq": seq}
+        for seq in range(size)
+    ]
+
+
+# show_loading_bar가 그리는 HTML을 받아 두는 자리
+class Placeholder:
+    def markdown(self, body, **kwargs):
+        self.body = body
+
+
+# 상담 기록 HTML을 처음부터 모두 생성 (메시지 id별 캐시를 비운 상태)
+def render_history(history):
+    st.session_state.rendered_html = {}
+    return [render_message_html(message) for message in history]
+
+
+def build_cases():
+    """(이름, 함수, 사진 data URL 길이, 이 함수가 끝난 뒤의 최대 메모리도 잴 단계 이름) 목록"""
+    photos = {
+        f"encode_image[{image_format.lower()}-{edge}]": make_photo(edge, image_format)
+        for image_format, edge in (("JPEG", 640), ("JPEG", 1600), ("JPEG", 4000), ("PNG", 1600))
+    }
+    encoded = encode_image_bytes(photos["encode_image[jpeg-1600]"])
+    url_bytes = len(encoded["url"])
+    histories = {size: make_history(size) for size in HISTORY_SIZES}
+    st.session_state.context_summary = {"text": "", "upto": 0}
+    placeholder = Placeholder()
+    long_answer = histories[10][1]["content"] * 10
+
+    cases = [
+        (name, lambda data=data: encode_image_bytes(data), len(encode_image_bytes(data)["url"]), "preprocess_image")
+        for name, data in photos.items()
+    ]
+    for size in (10, 100):
+        cases.append((f"advice_payload[history-{size}]", lambda history=histories[size]: build_advice_messages(
+            "아이가 39도 열이 나고 발진이 있어요", [encoded], build_context_messages(history, "아이가 39도 열이 나고 발진이 있어요")
+        ), url_bytes, None))
+    cases.append(("loading_bar[100-steps]", lambda: [show_loading_bar(progress, placeholder) for progress in range(100)], None, None))
+    for size in HISTORY_SIZES:
+        cases.append((f"history_html[{size}]", lambda history=histories[size]: render_history(history), None, None))
+    cases.append(("copy_box_text[long-answer]", lambda: copy_box_text(long_answer), None, None))
+    for count in (1, 4):
+        cases.append((f"vision_json[{count}-images]", lambda count=count: json.dumps(build_image_messages([encoded] * count)), url_bytes, None))
+    return cases
+
+
+# 호출당 시간 중앙값 (초)
+def measure_time(function, repeat):
+    started = time.perf_counter()
+    function()
+    number = max(1, int(MIN_SAMPLE_SECONDS / max(time.perf_counter() - started, 1e-9)))
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            function()
+        samples.append((time.perf_counter() - started) / number)
+    return statistics.median(samples)
+
+
+# 한 번 호출하는 동안의 최대 추가 메모리 (바이트)
+def measure_peak_memory(function, stage=None):
+    """(전체 최대, stage 함수가 끝난 뒤부터의 최대) 반환
+
+    전처리처럼 앞 단계의 최대 메모리가 크면 뒤 단계에서 생긴 복사본이 전체 최대에 묻히므로 따로 잼
+    """
+    original = getattr(streamlit_app, stage) if stage else None
+    marks = {}
+
+    def reset_after(*args, **kwargs):
+        result = original(*args, **kwargs)
+        current, peak = tracemalloc.get_traced_memory()
+        marks["peak"] = peak
+        tracemalloc.reset_peak()
+        marks["start"] = current
+        return result
+
+    if stage:
+        setattr(streamlit_app, stage, reset_after)
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        if stage:
+            setattr(streamlit_app, stage, original)
+    if not stage:
+        return peak - baseline, None
+    return max(peak, marks["peak"]) - baseline, peak - marks["start"]
+
+
+# 기준 대비 허용하는 메모리 증가량 (사진이 있으면 data URL 복사본 하나를 잡을 수 있도록 URL 길이의 절반)
+def memory_allowance(expected_peak, payload_bytes, tolerance):
+    if payload_bytes:
+        return payload_bytes / 2
+    return expected_peak * (tolerance - 1) + 64 * 1024
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    baseline = json.loads(BASELINE_PATH.read_text(encoding="utf-8")) if BASELINE_PATH.exists() else {}
+    results, failures = {}, []
+
+    print(f"{'항목':<28}{'시간':>12}{'기준 대비':>10}{'최대 메모리':>14}{'기준 대비':>10}{'인코딩 단계':>14}")
+    for name, function, payload_bytes, stage in build_cases():
+        if args.filter not in name:
+            continue
+        seconds = measure_time(function, args.repeat)
+        peak, stage_peak = measure_peak_memory(function, stage)
+        results[name] = {"seconds": seconds, "peak_bytes": peak}
+        if payload_bytes:
+            results[name]["payload_bytes"] = payload_bytes
+        if stage_peak is not None:
+            results[name]["stage_peak_bytes"] = stage_peak
+        expected = baseline.get(name)
+        time_ratio = seconds / expected["seconds"] if expected else None
+        memory_ratio = peak / expected["peak_bytes"] if expected and expected["peak_bytes"] else None
+        print(
+            f"{name:<28}{seconds * 1000:>10.3f}ms{f'{time_ratio:.2f}x' if time_ratio else '-':>10}"
+            f"{peak / 1024:>12.1f}KiB{f'{memory_ratio:.2f}x' if memory_ratio else '-':>10}"
+            f"{f'{stage_peak / 1024:.1f}KiB' if stage_peak is not None else '-':>14}"
+        )
+        if not expected:
+            continue
+        if seconds > expected["seconds"] * args.time_tolerance:
+            failures.append(f"{name}: 시간 {time_ratio:.2f}배 (허용 {args.time_tolerance}배)")
+        allowance = memory_allowance(expected["peak_bytes"], payload_bytes, args.memory_tolerance)
+        if peak > expected["peak_bytes"] + allowance:
+            failures.append(f"{name}: 최대 메모리 {peak / 1024:.0f}KiB, 기준 {expected['peak_bytes'] / 1024:.0f}KiB + 허용 {allowance / 1024:.0f}KiB")
+        if stage_peak is not None and "stage_peak_bytes" in expected and stage_peak > expected["stage_peak_bytes"] + allowance:
+            failures.append(
+                f"{name}: 전처리 이후 최대 메모리 {stage_peak / 1024:.0f}KiB, "
+                f"기준 {expected['stage_peak_bytes'] / 1024:.0f}KiB + 허용 {allowance / 1024:.0f}KiB"
+            )
+
+    # 기기와 관계없이 확인할 수 있는 증가 추세 (메시지당 시간이 메시지 수와 함께 늘면 이차 이상)
+    smallest, largest = f"history_html[{HISTORY_SIZES[0]}]", f"history_html[{HISTORY_SIZES[-1]}]"
+    if smallest in results and largest in results:
+        per_message = {name: results[name]["seconds"] / size for name, size in ((smallest, HISTORY_SIZES[0]), (largest, HISTORY_SIZES[-1]))}
+        scaling = per_message[largest] / per_message[smallest]
+        print(f"상담 기록 HTML 메시지당 시간 {HISTORY_SIZES[0]}개→{HISTORY_SIZES[-1]}개: {scaling:.2f}배 (허용 {MAX_HISTORY_SCALING}배)")
+        if scaling > MAX_HISTORY_SCALING:
+            failures.append(f"상담 기록 HTML 생성이 메시지 수에 비례하지 않습니다 (메시지당 {scaling:.2f}배)")
+
+    if args.update_baseline:
+        BASELINE_PATH.write_text(json.dumps({**baseline, **results}, indent=2, sort_keys=True) + "\n", encoding="utf-8")
+        print(f"기준값 저장: {BASELINE_PATH}")
+        return 0
+    for failure in failures:
+        print(f"  실패: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
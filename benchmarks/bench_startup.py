@@ -0,0 +1,120 @@
+# 시작·재실행 시간 벤치마크
+#
+# 1) python -X importtime으로 streamlit_app 모듈을 새 프로세스에서 가져오는 시간을 재고,
+#    무거운 모듈(openai, PIL, numpy 등)이 가져오는 시점에 같이 로드되지 않는지 확인합니다.
+# 2) Streamlit AppTest로 API 키 입력 화면과 상담 기록이 쌓인 화면을 반복 재실행하며 시간을 잽니다.
+# 기준을 넘거나 지연 로드 대상 모듈이 미리 로드되면 0이 아닌 코드로 종료합니다.
+#
+# 실행 예시:
+#   $ python benchmarks/bench_startup.py
+#   $ python benchmarks/bench_startup.py --reruns 50 --history 400 --max-rerun-ms 200
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+APP_PATH = ROOT / "streamlit_app.py"
+
+# 처음 실제로 쓸 때까지 불러오지 않아야 하는 모듈
+LAZY_MODULES = ("openai", "PIL", "numpy", "tiktoken", "requests", "http.server")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="streamlit_app의 가져오기·재실행 시간을 측정합니다.")
+    parser.add_argument("--import-runs", type=int, default=5, help="가져오기 시간 측정 횟수 (최솟값 사용)")
+    parser.add_argument("--reruns", type=int, default=20, help="화면별 재실행 측정 횟수")
+    parser.add_argument("--history", type=int, default=200, help="재실행 측정 시 미리 채워 둘 상담 메시지 수")
+    parser.add_argument("--max-import-ms", type=float, default=1500, help="모듈 가져오기 시간 상한 (ms)")
+    parser.add_argument("--max-rerun-ms", type=float, default=500, help="재실행 p50 상한 (ms)")
+    return parser.parse_args(argv)
+
+
+def measure_import():
+    """새 프로세스에서 (streamlit_app 누적 가져오기 시간 ms, 자체 시간 상위 모듈, 미리 로드된 지연 모듈) 반환"""
+    code = (
+        "import sys, streamlit_app; "
+        f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    cumulative_us, heaviest = None, []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, total_us, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        heaviest.append((int(self_us), name.strip()))
+        if name.strip() == "streamlit_app":
+            cumulative_us = int(total_us)
+    heaviest.sort(reverse=True)
+    eager = [name for name in result.stdout.strip().split(",") if name]
+    return cumulative_us / 1000, heaviest[:5], eager
+
+
+def time_reruns(app_test, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        app_test.run()
+        timings.append((time.perf_counter() - started) * 1000)
+        if app_test.exception:
+            raise RuntimeError(app_test.exception[0].value)
+    return statistics.median(timings), max(timings)
+
+
+def measure_reruns(runs, history):
+    from streamlit.testing.v1 import AppTest
+
+    login = AppTest.from_file(str(APP_PATH), default_timeout=60)
+    login.run()
+    login_timing = time_reruns(login, runs)
+    # API 키 입력 화면에서는 openai를 불러오지 않아야 함
+    openai_loaded = "openai" in sys.modules
+
+    chat = AppTest.from_file(str(APP_PATH), default_timeout=60)
+    chat.session_state.authenticated = True
+    chat.session_state.api_key = "sk-" + "x" * 40
+    chat.session_state.messages = [
+        {"role": "user" if seq % 2 == 0 else "bot", "content": f"상담 메시지 {seq} " * 20, "id": f"{'user' if seq % 2 == 0 else 'bot'}_{seq}", "seq": seq}
+        for seq in range(history)
+    ]
+    chat.session_state.message_seq = history
+    chat.run()
+    chat_timing = time_reruns(chat, runs)
+    return login_timing, chat_timing, openai_loaded
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # 벤치마크 중에는 상담 기록을 디스크에 남기지 않음
+    os.environ.setdefault("CONSULT_DB", "")
+    failed = False
+
+    import_ms, heaviest, eager = min((measure_import() for _ in range(args.import_runs)), key=lambda result: result[0])
+    print(f"모듈 가져오기 {import_ms:.0f}ms (상한 {args.max_import_ms:.0f}ms)")
+    for self_us, name in heaviest:
+        print(f"  {self_us / 1000:7.1f}ms  {name}")
+    if eager:
+        print(f"  지연 로드 대상인데 미리 로드됨: {', '.join(eager)}")
+        failed = True
+    failed |= import_ms > args.max_import_ms
+
+    sys.path.insert(0, str(ROOT))
+    (login_p50, login_max), (chat_p50, chat_max), openai_loaded = measure_reruns(args.reruns, args.history)
+    print(f"API 키 화면 재실행 p50 {login_p50:.1f}ms · 최대 {login_max:.1f}ms")
+    print(f"상담 화면(메시지 {args.history}개) 재실행 p50 {chat_p50:.1f}ms · 최대 {chat_max:.1f}ms (상한 {args.max_rerun_ms:.0f}ms)")
+    if openai_loaded:
+        print("  API 키 화면에서 openai가 로드됨")
+        failed = True
+    failed |= max(login_p50, chat_p50) > args.max_rerun_ms
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
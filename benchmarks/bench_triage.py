@@ -0,0 +1,72 @@
+# 응급 신호 분류 벤치마크
+#
+# triage_corpus.jsonl의 라벨이 붙은 증상 문장으로 재현율·오탐과 분류 지연시간을 확인합니다.
+# 말뭉치는 위험 표현 목록을 보지 않고 보호자가 실제로 쓸 법한 문장으로 작성했으므로, 두 문장을 함께
+# 읽어야 하는 사례("머리를 부딪혔는데 계속 토해요") 등 일부는 놓칩니다. 기준 재현율은 현재 측정값입니다.
+# 재현율이 기준보다 낮거나, 오탐이 기준보다 많거나, p99 지연시간이 기준을 넘으면 0이 아닌 코드로 종료합니다.
+#
+# 실행 예시:
+#   $ python benchmarks/bench_triage.py
+#   $ python benchmarks/bench_triage.py --min-recall 1.0 --max-p99-ms 1
+
+import argparse
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from streamlit_app import triage_symptoms  # noqa: E402
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="응급 신호 분류의 재현율과 지연시간을 측정합니다.")
+    parser.add_argument("--corpus", default=str(Path(__file__).with_name("triage_corpus.jsonl")), help="라벨이 붙은 증상 JSONL")
+    parser.add_argument("--repeat", type=int, default=200, help="지연시간 측정 반복 횟수")
+    parser.add_argument("--min-recall", type=float, default=0.94, help="응급 사례 최소 재현율")
+    parser.add_argument("--max-false-alarms", type=int, default=0, help="비응급 사례를 응급으로 분류한 건수 상한")
+    parser.add_argument("--max-p99-ms", type=float, default=1.0, help="분류 한 번의 p99 지연시간 상한 (ms)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.corpus, encoding="utf-8") as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+
+    misses, false_alarms = [], []
+    for case in cases:
+        flagged = triage_symptoms(case["text"])["level"] is not None
+        if case["emergency"] and not flagged:
+            misses.append(case["text"])
+        elif flagged and not case["emergency"]:
+            false_alarms.append(case["text"])
+
+    timings = []
+    for _ in range(args.repeat):
+        for case in cases:
+            started = time.perf_counter()
+            triage_symptoms(case["text"])
+            timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    p50 = statistics.median(timings)
+    p99 = timings[int(len(timings) * 0.99) - 1]
+
+    emergencies = sum(case["emergency"] for case in cases)
+    recall = 1 - len(misses) / emergencies if emergencies else 1.0
+    print(f"사례 {len(cases)}건 (응급 {emergencies}건)")
+    print(f"재현율 {recall:.3f} · 오탐 {len(false_alarms)}건")
+    print(f"지연시간 p50 {p50:.3f}ms · p99 {p99:.3f}ms")
+    for text in misses:
+        print(f"  놓침: {text}")
+    for text in false_alarms:
+        print(f"  오탐: {text}")
+
+    failed = recall < args.min_recall or len(false_alarms) > args.max_false_alarms or p99 >= args.max_p99_ms
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
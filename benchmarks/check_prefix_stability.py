@@ -0,0 +1,166 @@
+# 프롬프트 앞부분 고정 여부 확인
+#
+# OpenAI 프롬프트 캐시는 요청 앞부분이 바이트 단위로 같고 1024토큰 이상일 때만 적중합니다.
+# API를 호출하지 않고 streamlit_app.py의 메시지 구성 코드로 요청을 만들어 다음을 확인합니다.
+# 1) 증상·사진 수가 달라도 상담·이미지 분석 요청의 시스템 프롬프트와 고정 문구가 같은지
+# 2) 여러 턴 상담에서 요약이 갱신되기 전까지 직전 요청(새 질문 제외)이 다음 요청의 앞부분과 같은지
+# 앞부분이 어긋나면 0이 아닌 코드로 종료하고, 턴별 공통 앞부분 토큰 수와 예상 캐시 적중률을 출력합니다.
+#
+# 실행 예시:
+#   $ python benchmarks/check_prefix_stability.py
+#   $ python benchmarks/check_prefix_stability.py --turns 20 --min-prefix-tokens 1024
+
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# 검사 중에는 상담 기록을 디스크에 남기지 않고, 실행 컨텍스트 없이 session_state를 쓸 때의 경고를 숨김
+os.environ.setdefault("CONSULT_DB", "")
+
+import streamlit as st  # noqa: E402
+from streamlit.logger import set_log_level  # noqa: E402
+
+import streamlit_app  # noqa: E402
+from streamlit_app import (  # noqa: E402
+    build_advice_messages,
+    build_context_messages,
+    build_image_messages,
+    count_message_tokens,
+    update_context_summary,
+)
+
+set_log_level("error")
+
+# OpenAI 프롬프트 캐시 최소 길이와 적중 단위 (토큰)
+CACHE_MIN_TOKENS = 1024
+CACHE_INCREMENT = 128
+
+# 사진 대신 쓰는 고정 데이터 URL (앞부분 비교에는 내용이 상관없음)
+FAKE_IMAGE = {"url": "data:image/jpeg;base64,/9j/4AAQ", "detail": "low", "stats": {"estimated_tokens": 85}}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="요청 앞부분이 프롬프트 캐시에 맞게 고정되어 있는지 확인합니다.")
+    parser.add_argument("--corpus", default=str(Path(__file__).with_name("triage_corpus.jsonl")), help="증상 문장 JSONL")
+    parser.add_argument("--turns", type=int, default=12, help="모의 상담 턴 수")
+    parser.add_argument("--min-prefix-tokens", type=int, default=0, help="턴 사이 공통 앞부분 토큰 수 하한 (0이면 확인 안 함)")
+    return parser.parse_args(argv)
+
+
+# 메시지를 실제 요청 본문과 같은 방식으로 직렬화
+def serialize(message):
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+
+
+# 두 요청이 앞에서부터 몇 개의 메시지를 똑같이 공유하는지
+def shared_messages(previous, current):
+    count = 0
+    for a, b in zip(previous, current):
+        if serialize(a) != serialize(b):
+            break
+        count += 1
+    return count
+
+
+# 앞부분 토큰 중 캐시에서 읽을 수 있는 토큰 수 (1024 이상부터 128 단위)
+def cacheable_tokens(prefix_tokens):
+    if prefix_tokens < CACHE_MIN_TOKENS:
+        return 0
+    return prefix_tokens - (prefix_tokens - CACHE_MIN_TOKENS) % CACHE_INCREMENT
+
+
+# 상담마다 같은 고정 앞부분을 쓰는지 확인
+def check_static_prefix(symptom_texts):
+    failures = []
+    advice_requests = [
+        (text, build_advice_messages(text, [FAKE_IMAGE] * images))
+        for text in symptom_texts for images in (0, 1, 3)
+    ]
+    if len({serialize(messages[0]) for _, messages in advice_requests}) != 1:
+        failures.append("상담 요청의 시스템 프롬프트가 요청마다 다릅니다.")
+    # 사진 안내 문구는 사진 뒤에 붙고 증상 문구는 사진 수와 관계없이 같아야 함
+    for text, messages in advice_requests:
+        if messages[-1]["content"][0] != {"type": "text", "text": f"증상: {text}"}:
+            failures.append(f"상담 요청의 첫 항목이 사진 수에 따라 달라집니다: {text[:40]}")
+            break
+
+    image_requests = [build_image_messages([FAKE_IMAGE] * images) for images in range(1, 5)]
+    prefixes = {serialize(messages[0]) + serialize(messages[1]["content"][0]) for messages in image_requests}
+    if len(prefixes) != 1:
+        failures.append("이미지 분석 요청의 시스템 프롬프트나 고정 문구가 사진 수에 따라 달라집니다.")
+    return failures, count_message_tokens(advice_requests[0][1][:1]), count_message_tokens(image_requests[0][:1])
+
+
+# 요약 요청에 답하는 클라이언트 (요약 내용은 접은 턴 수만 기록)
+class SummaryClient:
+    def __init__(self):
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **request):
+        self.calls += 1
+        content = f"아이 상담 요약 {self.calls}회차: " + request["messages"][-1]["content"][-80:]
+        usage = SimpleNamespace(prompt_tokens=count_message_tokens(request["messages"]), completion_tokens=40, total_tokens=0)
+        usage.total_tokens = usage.prompt_tokens + usage.completion_tokens
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+
+# 여러 턴 상담을 흉내 내며 턴 사이 요청 앞부분이 유지되는지 확인
+def check_conversation(symptom_texts, turns):
+    summary_client = SummaryClient()
+    streamlit_app.get_openai_client = lambda api_key: summary_client
+    st.session_state.api_key = "sk-prefix-check"
+    st.session_state.context_summary = {"text": "", "upto": 0}
+
+    history, failures, rows = [], [], []
+    previous = None
+    for turn in range(turns):
+        symptoms = symptom_texts[turn % len(symptom_texts)] + f" ({turn + 1}번째 질문)"
+        messages = build_advice_messages(symptoms, context=build_context_messages(history, symptoms))
+        summary_version = summary_client.calls
+        if previous is not None:
+            shared = shared_messages(previous["messages"][:-1], messages)
+            expected = len(previous["messages"]) - 1
+            if shared < expected and previous["summary_version"] == summary_version:
+                failures.append(f"{turn + 1}번째 턴: 요약 갱신 없이 직전 요청의 앞부분이 바뀌었습니다 ({shared}/{expected}개 메시지 일치).")
+            prefix_tokens = count_message_tokens(messages[:shared])
+        else:
+            prefix_tokens = count_message_tokens(messages[:1])
+        total_tokens = count_message_tokens(messages)
+        rows.append((turn + 1, total_tokens, prefix_tokens, cacheable_tokens(prefix_tokens) / total_tokens, previous is not None and previous["summary_version"] != summary_version))
+        previous = {"messages": messages, "summary_version": summary_version}
+
+        seq = len(history)
+        history.append({"role": "user", "content": symptoms, "seq": seq})
+        history.append({"role": "bot", "content": f"{turn + 1}번째 답변입니다. " * 30, "seq": seq + 1})
+        update_context_summary(history, wait=True)
+    return failures, rows
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.corpus, encoding="utf-8") as f:
+        symptom_texts = [json.loads(line)["text"] for line in f if line.strip()]
+
+    failures, advice_tokens, image_tokens = check_static_prefix(symptom_texts)
+    print(f"고정 앞부분: 상담 시스템 프롬프트 약 {advice_tokens}토큰 · 이미지 분석 시스템 프롬프트 약 {image_tokens}토큰 (캐시 최소 {CACHE_MIN_TOKENS}토큰)")
+
+    conversation_failures, rows = check_conversation(symptom_texts, args.turns)
+    failures += conversation_failures
+    print("턴  요청 토큰  공통 앞부분  예상 캐시 적중")
+    for turn, total_tokens, prefix_tokens, ratio, folded in rows:
+        print(f"{turn:>2}  {total_tokens:>9,}  {prefix_tokens:>11,}  {ratio:>13.0%}{'  (요약 갱신)' if folded else ''}")
+        if args.min_prefix_tokens and turn > 1 and not folded and prefix_tokens < args.min_prefix_tokens:
+            failures.append(f"{turn}번째 턴: 공통 앞부분 {prefix_tokens}토큰이 하한 {args.min_prefix_tokens}토큰보다 짧습니다.")
+
+    for failure in failures:
+        print(f"  실패: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+# 길이 한도에서 끊긴 답변 처리 확인
+#
+# 로컬 목 서버가 max_tokens에서 답변을 끊도록(finish_reason=length) 설정하고 AppTest로 실제 화면 흐름을 거쳐 다음을 확인합니다.
+# 1) 짧은 질문 규칙(gpt-4o-mini, 작은 max_tokens)으로 끊긴 답변 끝에 끊김 안내와 면책 문구가 붙는지
+# 2) 끊긴 답변은 응답 캐시·유사 질문 캐시에 저장되지 않아 같은 질문을 다시 하면 새로 요청하는지
+# 3) 끊기지 않은 답변은 그대로 저장되어 다시 물으면 캐시로 답하는지
+# 4) 종합 상담 + 이미지 정밀 분석 동시 요청에서도 끊긴 답변마다 같은 처리를 하는지
+# 스트리밍·일반 응답 모두 확인하고, 하나라도 어긋나면 0이 아닌 코드로 종료합니다.
+#
+# 실행 예시:
+#   $ python benchmarks/check_truncated_answers.py
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+APP_PATH = ROOT.parent / "streamlit_app.py"
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT.parent))
+
+import load_test  # noqa: E402
+import mock_openai_server  # noqa: E402
+from streamlit_app import DEFAULT_ROUTING_RULES, MEDICAL_DISCLAIMER, TRUNCATED_ANSWER_NOTE  # noqa: E402
+
+# 짧은 질문 규칙의 답변 길이 한도보다 길고, 기본 한도(1200)보다는 짧은 답변
+SHORT_ROUTE_TOKENS = next(rule["max_tokens"] for rule in DEFAULT_ROUTING_RULES if rule["name"] == "short_question")
+COMPLETION_TOKENS = SHORT_ROUTE_TOKENS + 100
+# 사진 분석 한도(1500)까지 넘는 답변 (동시 요청 두 건 모두 끊김)
+LONG_COMPLETION_TOKENS = 2000
+
+
+# 새 세션으로 질문 하나를 보내고 (마지막 챗봇 답변, 목 서버가 받은 상담 요청 수) 반환
+def consult(server, text, streaming, photo=None):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(str(APP_PATH), default_timeout=60)
+    at.run()
+    at.text_input[0].input("sk-truncation-check-" + "x" * 24)
+    at.button[0].click().run()
+    at.toggle(key="streaming").set_value(streaming).run()
+    if photo is not None:
+        at.file_uploader[0].set_value([("photo.jpg", photo, "image/jpeg")]).run()
+        at.checkbox(key="combined_mode").check().run()
+    before = server.snapshot()["status"].get("200", 0)
+    at.text_area[0].input(text)
+    next(button for button in at.button if "종합 상담" in button.label).click().run()
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+    return at.session_state.messages[-1]["content"], server.snapshot()["status"].get("200", 0) - before
+
+
+def main():
+    server = mock_openai_server.start_server(mock_openai_server.parse_args([
+        "--latency", "0", "--jitter", "0", "--tokens-per-second", "0", "--completion-tokens", str(COMPLETION_TOKENS), "--seed", "0"
+    ]))
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+    os.environ.setdefault("CONSULT_DB", str(Path(tempfile.mkdtemp(prefix="truncation-check-")) / "consultations.db"))
+    load_test.share_apptest_state()
+
+    failures = []
+
+    def check(condition, message):
+        print(f"  {'통과' if condition else '실패'}: {message}")
+        if not condition:
+            failures.append(message)
+
+    for streaming in (True, False):
+        mode = "스트리밍" if streaming else "일반 응답"
+        server.settings.completion_tokens = COMPLETION_TOKENS
+        print(f"[{mode}] 짧은 질문 (max_tokens {SHORT_ROUTE_TOKENS}, 답변 {COMPLETION_TOKENS}토큰)")
+        short = f"아이가 콧물이 나요 ({mode})"
+        content, requests = consult(server, short, streaming)
+        check(requests == 1, f"모델을 한 번 호출함 ({requests}건)")
+        check(TRUNCATED_ANSWER_NOTE in content and content.endswith(MEDICAL_DISCLAIMER), "끊김 안내와 면책 문구가 붙음")
+        _, requests = consult(server, short, streaming)
+        check(requests == 1, f"같은 질문을 다시 하면 캐시 대신 새로 요청함 ({requests}건)")
+
+        print(f"[{mode}] 긴 질문 (기본 한도, 끊기지 않음)")
+        long = f"아이가 어제 저녁부터 맑은 콧물이 나고 가끔 재채기를 하는데 잘 먹고 잘 놀아요. 집에서 어떻게 돌보면 될까요? ({mode})"
+        content, requests = consult(server, long, streaming)
+        check(requests == 1 and TRUNCATED_ANSWER_NOTE not in content, "끊김 안내 없이 답변함")
+        _, requests = consult(server, long, streaming)
+        check(requests == 0, f"같은 질문을 다시 하면 캐시로 답함 ({requests}건)")
+
+        print(f"[{mode}] 종합 상담 + 이미지 정밀 분석 (답변 {LONG_COMPLETION_TOKENS}토큰, 두 요청 모두 끊김)")
+        server.settings.completion_tokens = LONG_COMPLETION_TOKENS
+        photo = load_test.make_photo(64)
+        combined = f"팔에 발진이 생겼어요 ({mode})"
+        content, requests = consult(server, combined, streaming, photo)
+        check(requests == 2, f"두 요청을 동시에 보냄 ({requests}건)")
+        check(content.count(TRUNCATED_ANSWER_NOTE) == 2 and content.endswith(MEDICAL_DISCLAIMER), "두 답변 모두 끊김 안내와 면책 문구가 붙음")
+        _, requests = consult(server, combined, streaming, photo)
+        check(requests == 2, f"같은 질문을 다시 하면 두 요청 모두 새로 보냄 ({requests}건)")
+
+    server.shutdown()
+    print(f"실패 {len(failures)}건")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,285 @@
+# 동시 세션 부하 테스트
+#
+# 로컬 목 서버(mock_openai_server.py)를 띄우고 Streamlit AppTest로 여러 세션을 동시에 실행해
+# 실제 main() 흐름(API 키 입력 → 텍스트 상담 → 사진만 분석 → 피드백)을 화면 위젯으로 그대로 거칩니다.
+# 동작별 p50/p95/p99 지연시간, 처리량, 세션당 메모리, 오류율과 목 서버가 받은 요청 집계를 출력하고
+# 예외가 나거나 기준을 넘으면 0이 아닌 코드로 종료합니다.
+# 스케줄러 한도 등 앱 설정은 평소처럼 환경 변수(SCHEDULER_TPM 등)로 지정합니다.
+#
+# 실행 예시:
+#   $ python benchmarks/load_test.py --sessions 20 --consults 3
+#   $ python benchmarks/load_test.py --sessions 50 --error-rate-429 0.05 --error-rate-500 0.01 --output load.json
+#   $ python benchmarks/load_test.py --base-url http://127.0.0.1:8000/v1   # 이미 떠 있는 목 서버 사용
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+APP_PATH = ROOT.parent / "streamlit_app.py"
+sys.path.insert(0, str(ROOT))
+
+import mock_openai_server  # noqa: E402
+
+# share_apptest_state가 바꾸는 Streamlit 내부 구현을 확인한 버전 (다른 버전이면 경고만 하고, 필요한 속성이 없으면 중단)
+TESTED_STREAMLIT_VERSION = "1.66"
+
+# 응답이 오류 안내로 바뀐 경우를 알아보는 문구 (앱의 오류·대기열 초과 안내)
+ERROR_MARKERS = ("오류가 발생했습니다", "요청이 많아", "요청이 취소되었습니다")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="목 서버와 AppTest 세션으로 동시 상담 부하를 측정합니다.")
+    parser.add_argument("--sessions", type=int, default=10, help="동시에 실행할 세션 수")
+    parser.add_argument("--consults", type=int, default=2, help="세션당 텍스트 상담 횟수")
+    parser.add_argument("--images", type=int, default=1, help="세션당 '이미지만 분석하기'에 첨부할 사진 수 (0이면 생략)")
+    parser.add_argument("--image-edge", type=int, default=1600, help="첨부 사진의 긴 변 (px)")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="모든 세션이 시작될 때까지의 시간 (초)")
+    parser.add_argument("--timeout", type=float, default=120, help="화면 실행 한 번의 제한 시간 (초)")
+    parser.add_argument("--corpus", default=str(ROOT / "triage_corpus.jsonl"), help="상담에 쓸 증상 문장 JSONL")
+    parser.add_argument("--base-url", help="이미 실행 중인 OpenAI 호환 서버 주소 (지정하지 않으면 목 서버를 함께 띄움)")
+    parser.add_argument("--latency", type=float, default=0.3, help="목 서버 첫 토큰 지연시간 (초)")
+    parser.add_argument("--tokens-per-second", type=float, default=100, help="목 서버 출력 토큰 속도")
+    parser.add_argument("--completion-tokens", type=int, default=200, help="목 서버 응답당 출력 토큰 수")
+    parser.add_argument("--error-rate-429", type=float, default=0.0, help="목 서버 429 응답 비율")
+    parser.add_argument("--error-rate-500", type=float, default=0.0, help="목 서버 500 응답 비율")
+    parser.add_argument("--max-p95-s", type=float, default=30.0, help="상담 동작 p95 지연시간 상한 (초)")
+    parser.add_argument("--max-error-rate", type=float, default=0.05, help="오류 안내로 끝난 동작 비율 상한")
+    parser.add_argument("--output", help="결과를 JSON으로 저장할 경로")
+    return parser.parse_args(argv)
+
+
+# AppTest는 화면 실행마다 스크립트를 새로 컴파일하고 끝날 때 전역 Runtime을 지우므로, 여러 세션을 스레드로
+# 동시에 실행할 때는 실제 서버처럼 컴파일 결과를 하나로 공유하고, 다른 세션이 실행 중인 동안에도
+# 마지막으로 만든 모의 Runtime을 계속 쓰도록 함
+def share_apptest_state():
+    import streamlit
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import app_test, local_script_runner
+
+    missing = [
+        name for owner, name in (
+            (Runtime, "_instance"), (Runtime, "instance"), (Runtime, "exists"),
+            (app_test, "ScriptCache"), (local_script_runner, "ScriptCache")
+        )
+        if not hasattr(owner, name)
+    ]
+    if missing:
+        sys.exit(
+            f"Streamlit {streamlit.__version__}에는 부하 테스트가 바꾸는 내부 속성({', '.join(missing)})이 없습니다. "
+            f"{TESTED_STREAMLIT_VERSION}.x에서 확인한 share_apptest_state()를 새 버전에 맞게 고쳐야 합니다."
+        )
+    if not streamlit.__version__.startswith(f"{TESTED_STREAMLIT_VERSION}."):
+        print(
+            f"경고: Streamlit {streamlit.__version__}은 부하 테스트를 확인한 버전({TESTED_STREAMLIT_VERSION}.x)과 다릅니다. "
+            "세션 공유 방식이 달라졌을 수 있으니 결과를 확인하세요.",
+            file=sys.stderr
+        )
+
+    script_cache = ScriptCache()
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: script_cache
+    last = {}
+
+    def instance(cls):
+        if cls._instance is not None:
+            last["runtime"] = cls._instance
+            return cls._instance
+        if "runtime" not in last:
+            raise RuntimeError("Runtime hasn't been created!")
+        return last["runtime"]
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or "runtime" in last)
+
+
+# 현재 프로세스 RSS (바이트)
+def current_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# 세션마다 다른 내용의 사진 (응답 캐시에 걸리지 않도록 무작위 잡음)
+def make_photo(edge):
+    from PIL import Image
+    image = Image.effect_noise((edge, edge * 3 // 4), 64).convert("RGB")
+    buffer = BytesIO()
+    image.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+
+# 동작 결과 기록 (스레드 간 공유)
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.failures = []
+
+    def add(self, action, seconds, outcome):
+        with self.lock:
+            self.samples.setdefault(action, []).append((seconds, outcome))
+
+    def fail(self, session, action, error):
+        with self.lock:
+            self.failures.append(f"세션 {session} {action}: {error}")
+
+
+# 화면 동작 하나를 실행하고 시간·결과를 기록
+def timed(recorder, session, action, at, interact, check=None):
+    started = time.perf_counter()
+    interact()
+    seconds = time.perf_counter() - started
+    if at.exception:
+        recorder.add(action, seconds, "exception")
+        recorder.fail(session, action, at.exception[0].message)
+        return False
+    outcome = check() if check else "ok"
+    recorder.add(action, seconds, outcome)
+    return True
+
+
+# 마지막 챗봇 답변이 정상 답변인지 확인
+def bot_outcome(at):
+    content = at.session_state.messages[-1]["content"] if at.session_state.messages else ""
+    return "error" if any(marker in content for marker in ERROR_MARKERS) else "ok"
+
+
+# 세션 하나의 상담 흐름
+def run_session(index, args, texts, recorder, sessions):
+    from streamlit.testing.v1 import AppTest
+
+    time.sleep(args.ramp_up * index / max(1, args.sessions))
+    at = AppTest.from_file(str(APP_PATH), default_timeout=args.timeout)
+    sessions.append(at)
+    rng = random.Random(index)
+
+    at.run()
+    # 서버 키 모드(API_KEY_MODE=server)에서는 키 입력 화면 없이 바로 시작
+    if not at.session_state.authenticated:
+        at.text_input[0].input(f"sk-load-test-{index:04d}-" + "x" * 24)
+        if not timed(recorder, index, "login", at, lambda: at.button[0].click().run()):
+            return
+    # 세션마다 다른 질문이지만 비슷한 문장이 캐시 답변으로 처리되지 않도록 끔
+    at.toggle(key="use_cache").set_value(False).run()
+
+    consult = next(button for button in at.button if "종합 상담" in button.label)
+    for turn in range(args.consults):
+        at.text_area[0].input(f"{rng.choice(texts)} (세션 {index}, {turn + 1}번째 질문)")
+        consult = next(button for button in at.button if "종합 상담" in button.label)
+        if not timed(recorder, index, "consult", at, lambda: consult.click().run(), lambda: bot_outcome(at)):
+            return
+
+    if args.images:
+        at.text_area[0].input("")
+        at.file_uploader[0].set_value([(f"photo-{index}-{i}.jpg", make_photo(args.image_edge), "image/jpeg") for i in range(args.images)])
+        at.run()
+        analyze = next(button for button in at.button if "이미지만 분석" in button.label)
+        if not timed(recorder, index, "image", at, lambda: analyze.click().run(), lambda: bot_outcome(at)):
+            return
+        at.file_uploader[0].set_value(None).run()
+
+    last_bot = next(message for message in reversed(at.session_state.messages) if message["role"] == "bot")
+    timed(recorder, index, "feedback", at, lambda: at.button(key=f"good_{last_bot['id']}").click().run())
+
+
+def summarize(recorder, elapsed):
+    rows = {}
+    for action, samples in sorted(recorder.samples.items()):
+        seconds = [s for s, _ in samples]
+        errors = sum(outcome != "ok" for _, outcome in samples)
+        rows[action] = {
+            "count": len(samples),
+            "errors": errors,
+            "error_rate": errors / len(samples),
+            "p50": percentile(seconds, 0.50),
+            "p95": percentile(seconds, 0.95),
+            "p99": percentile(seconds, 0.99),
+            "throughput_per_s": len(samples) / elapsed
+        }
+    return rows
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.corpus, encoding="utf-8") as f:
+        texts = [json.loads(line)["text"] for line in f if line.strip()]
+
+    server = None
+    if args.base_url:
+        base_url = args.base_url
+    else:
+        server = mock_openai_server.start_server(mock_openai_server.parse_args([
+            "--latency", str(args.latency), "--tokens-per-second", str(args.tokens_per_second),
+            "--completion-tokens", str(args.completion_tokens), "--error-rate-429", str(args.error_rate_429),
+            "--error-rate-500", str(args.error_rate_500), "--seed", "0"
+        ]))
+        base_url = server.base_url
+    # 앱의 OpenAI 클라이언트는 OPENAI_BASE_URL을 따름, 상담 기록은 임시 DB에 저장
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("CONSULT_DB", str(Path(tempfile.mkdtemp(prefix="load-test-")) / "consultations.db"))
+
+    share_apptest_state()
+    # 모듈 가져오기·캐시 초기화 비용이 세션 메모리에 섞이지 않도록 한 세션을 먼저 실행
+    run_session(0, argparse.Namespace(**{**vars(args), "ramp_up": 0, "consults": 1, "images": 0}), texts, Recorder(), [])
+    baseline_rss = current_rss_bytes()
+
+    recorder, sessions = Recorder(), []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+        futures = [executor.submit(run_session, index, args, texts, recorder, sessions) for index in range(1, args.sessions + 1)]
+        for index, future in enumerate(futures, 1):
+            try:
+                future.result()
+            except Exception as e:
+                recorder.fail(index, "session", f"{type(e).__name__}: {e}")
+    elapsed = time.perf_counter() - started
+    memory_per_session = (current_rss_bytes() - baseline_rss) / max(1, len(sessions))
+
+    rows = summarize(recorder, elapsed)
+    print(f"세션 {args.sessions}개 · {elapsed:.1f}초 · 세션당 메모리 약 {memory_per_session / 2**20:.1f}MiB (한 프로세스 RSS 증가분 기준 추정치)")
+    print(f"{'동작':<10}{'건수':>6}{'오류율':>8}{'p50':>8}{'p95':>8}{'p99':>8}{'처리량/초':>10}")
+    for action, row in rows.items():
+        print(f"{action:<10}{row['count']:>6}{row['error_rate']:>8.1%}{row['p50']:>7.2f}s{row['p95']:>7.2f}s{row['p99']:>7.2f}s{row['throughput_per_s']:>10.2f}")
+    report = {"sessions": args.sessions, "elapsed_s": elapsed, "memory_per_session_bytes": memory_per_session, "actions": rows}
+    if server is not None:
+        report["server"] = stats = server.snapshot()
+        cached_share = stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0
+        print(
+            f"목 서버: 요청 {stats['requests']}건 {stats['status']} · 사진 {stats['images']}장 {stats['image_bytes'] / 2**20:.1f}MiB "
+            f"(예상 {stats['image_tokens']:,}토큰) · 최대 본문 {stats['max_request_bytes'] / 2**10:.0f}KiB · 캐시된 입력 {cached_share:.0%}"
+        )
+        server.shutdown()
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    for failure in recorder.failures:
+        print(f"  실패: {failure}")
+    consult_p95 = max((rows[action]["p95"] for action in ("consult", "image") if action in rows), default=0)
+    total = sum(row["count"] for action, row in rows.items() if action != "login")
+    errors = sum(row["errors"] for action, row in rows.items() if action != "login")
+    failed = bool(recorder.failures) or consult_p95 > args.max_p95_s or (total and errors / total > args.max_error_rate)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,321 @@
+# OpenAI 호환 로컬 목 서버
+#
+# 실제 API 없이 앱·배치 실행기·부하 테스트를 돌려볼 수 있도록 /v1/chat/completions를 흉내 냅니다.
+# - 스트리밍(SSE)·일반 응답, 첫 토큰 지연시간과 초당 출력 토큰 수 조절
+# - 정해진 비율로 429(Retry-After 포함)·500 오류 주입
+# - 요청 본문 크기, 사진 장수·디코딩 크기·예상 이미지 토큰 집계 (GET /stats)
+# - 요청 앞부분이 이전 요청과 같으면 OpenAI처럼 prompt_tokens_details.cached_tokens를 채움
+# - max_tokens가 --completion-tokens보다 작으면 답변을 끊고 finish_reason=length로 응답
+# - sk-invalid로 시작하는 키는 401로 거절, sk-restricted로 시작하는 키는 모델 목록만 403 (API 키 확인 흐름 점검용)
+#
+# 실행 예시:
+#   $ python benchmarks/mock_openai_server.py --port 8000 --latency 0.5 --tokens-per-second 40 --error-rate-429 0.05
+#   $ OPENAI_BASE_URL=http://127.0.0.1:8000/v1 streamlit run streamlit_app.py
+#   $ python batch_consult.py cases.jsonl --base-url http://127.0.0.1:8000/v1 --api-key sk-mock-000000000000000000
+#   $ curl http://127.0.0.1:8000/stats
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from streamlit_app import count_tokens, estimate_image_tokens  # noqa: E402
+
+# OpenAI 프롬프트 캐시 최소 길이와 적중 단위 (토큰)
+CACHE_MIN_TOKENS = 1024
+CACHE_INCREMENT = 128
+CACHE_ENTRIES = 10000
+
+# 응답으로 돌려줄 상담 문구 (출력 토큰 수만큼 단어를 반복)
+ANSWER_WORDS = (
+    "🔍 가능한 원인: 목 서버 응답입니다. 🏠 가정에서의 대처: 충분한 수분 섭취와 휴식을 권합니다. "
+    "🚨 병원 방문이 필요한 경우: 증상이 악화되면 진료를 받으세요. ⚠️ 주의사항: 이 답변은 부하 테스트용입니다."
+).split(" ")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="OpenAI chat completions API를 흉내 내는 로컬 서버를 실행합니다.")
+    parser.add_argument("--host", default="127.0.0.1", help="바인드 주소")
+    parser.add_argument("--port", type=int, default=8000, help="포트 (0이면 빈 포트)")
+    parser.add_argument("--latency", type=float, default=0.3, help="첫 토큰까지의 지연시간 (초)")
+    parser.add_argument("--jitter", type=float, default=0.1, help="지연시간에 더할 무작위 비율 (0.1이면 ±10%%)")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="출력 토큰 생성 속도 (0이면 지연 없이 한 번에)")
+    parser.add_argument("--completion-tokens", type=int, default=300, help="응답당 출력 토큰 수 (max_tokens를 넘으면 max_tokens에서 끊고 finish_reason=length)")
+    parser.add_argument("--error-rate-429", type=float, default=0.0, help="429 Too Many Requests로 응답할 비율")
+    parser.add_argument("--error-rate-500", type=float, default=0.0, help="500 Internal Server Error로 응답할 비율")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429 응답의 Retry-After (초)")
+    parser.add_argument("--seed", type=int, help="오류 주입·지연시간 난수 시드")
+    return parser.parse_args(argv)
+
+
+# 요청 내용 집계 (본문 크기, 텍스트 토큰, 사진 장수·크기·예상 토큰)
+def account_request(body, request):
+    usage = {"request_bytes": len(body), "text_tokens": 0, "images": 0, "image_bytes": 0, "image_tokens": 0}
+    prefix_tokens = []
+    for message in request.get("messages", []):
+        content = message.get("content") or ""
+        parts = [{"type": "text", "text": content}] if isinstance(content, str) else content
+        for part in parts:
+            if part.get("type") == "text":
+                usage["text_tokens"] += count_tokens(part["text"]) + 1
+            elif part.get("type") == "image_url":
+                image_bytes, tokens = account_image(part["image_url"])
+                usage["images"] += 1
+                usage["image_bytes"] += image_bytes
+                usage["image_tokens"] += tokens
+        # 메시지 경계마다 누적 토큰 수를 남겨 앞부분 캐시 적중을 계산
+        prefix_tokens.append(usage["text_tokens"] + usage["image_tokens"] + 4 * len(prefix_tokens))
+    usage["prompt_tokens"] = prefix_tokens[-1] if prefix_tokens else 0
+    return usage, prefix_tokens
+
+
+# 데이터 URL 사진 하나의 (디코딩 크기, 예상 토큰)
+def account_image(image_url):
+    url = image_url.get("url", "")
+    detail = image_url.get("detail", "auto")
+    if not url.startswith("data:"):
+        return 0, estimate_image_tokens(512, 512, detail)
+    data = base64.b64decode(url.split(",", 1)[1])
+    try:
+        from PIL import Image
+        with Image.open(BytesIO(data)) as image:
+            width, height = image.size
+    except Exception:
+        width = height = 512
+    return len(data), estimate_image_tokens(width, height, detail)
+
+
+# 앞부분 캐시 (메시지 경계까지의 해시 → 토큰 수)
+class PrefixCache:
+    def __init__(self, max_entries=CACHE_ENTRIES):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+
+    def lookup_and_store(self, request, prefix_tokens):
+        """이전 요청과 겹치는 가장 긴 앞부분의 캐시 토큰 수를 돌려주고 이번 요청의 앞부분을 저장"""
+        digest = hashlib.sha256(request.get("model", "").encode("utf-8"))
+        keys = []
+        for message in request.get("messages", []):
+            digest.update(json.dumps(message, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+            keys.append(digest.copy().hexdigest())
+        cached = 0
+        with self.lock:
+            for key, tokens in zip(keys, prefix_tokens):
+                if key not in self.entries:
+                    break
+                self.entries.move_to_end(key)
+                cached = tokens
+            for key, tokens in zip(keys, prefix_tokens):
+                self.entries[key] = tokens
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        if cached < CACHE_MIN_TOKENS:
+            return 0
+        return cached - (cached - CACHE_MIN_TOKENS) % CACHE_INCREMENT
+
+
+# 거절할 API 키 접두사
+INVALID_KEY_PREFIX = "sk-invalid"
+RESTRICTED_KEY_PREFIX = "sk-restricted"
+
+
+# 목 서버 (설정, 난수, 집계를 요청 처리 스레드끼리 공유)
+class MockOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, settings):
+        super().__init__(address, MockOpenAIHandler)
+        self.settings = settings
+        self.random = random.Random(settings.seed)
+        self.prefix_cache = PrefixCache()
+        self.lock = threading.Lock()
+        self.stats = {
+            "requests": 0, "streamed": 0, "status": {}, "request_bytes": 0, "max_request_bytes": 0,
+            "images": 0, "image_bytes": 0, "image_tokens": 0,
+            "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0
+        }
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def draw(self):
+        with self.lock:
+            return self.random.random()
+
+    def record(self, status, accounting=None, streamed=False):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["streamed"] += streamed
+            self.stats["status"][str(status)] = self.stats["status"].get(str(status), 0) + 1
+            for key, value in (accounting or {}).items():
+                if key in self.stats:
+                    self.stats[key] += value
+            if accounting:
+                self.stats["max_request_bytes"] = max(self.stats["max_request_bytes"], accounting["request_bytes"])
+
+    def handle_error(self, request, client_address):
+        # 클라이언트가 연결을 먼저 끊은 경우(취소, 종료)는 기록하지 않음
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    # 앱처럼 keep-alive 연결을 재사용할 수 있도록 HTTP/1.1로 응답 (스트리밍은 chunked 전송)
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path.startswith("/v1/") and not self.authorized():
+            return
+        if path == "/stats":
+            self.send_json(200, self.server.snapshot())
+        elif path == "/v1/models" and self.headers.get("Authorization", "").removeprefix("Bearer ").startswith(RESTRICTED_KEY_PREFIX):
+            # 모델 목록 읽기 권한이 없는 제한된 프로젝트 키 (상담 요청은 정상 처리)
+            self.server.record(403)
+            self.send_json(403, {"error": {"message": "Missing scopes: api.model.read (mock)", "type": "invalid_request_error", "code": None}})
+        elif path == "/v1/models":
+            self.send_json(200, {"object": "list", "data": [
+                {"id": model, "object": "model", "created": 0, "owned_by": "mock"} for model in ("gpt-4o", "gpt-4o-mini")
+            ]})
+        else:
+            self.send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.split("?")[0] != "/v1/chat/completions":
+            self.send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+            return
+        if not self.authorized():
+            return
+        settings = self.server.settings
+        draw = self.server.draw()
+        if draw < settings.error_rate_429:
+            self.server.record(429)
+            self.send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error"}},
+                           {"Retry-After": f"{settings.retry_after:g}"})
+            return
+        if draw < settings.error_rate_429 + settings.error_rate_500:
+            self.server.record(500)
+            self.send_json(500, {"error": {"message": "Internal server error (mock)", "type": "server_error"}})
+            return
+
+        request = json.loads(body)
+        accounting, prefix_tokens = account_request(body, request)
+        cached_tokens = self.server.prefix_cache.lookup_and_store(request, prefix_tokens)
+        completion_tokens = max(1, min(settings.completion_tokens, request.get("max_tokens") or settings.completion_tokens))
+        # 실제 API처럼 max_tokens에서 끊긴 답변은 finish_reason이 length
+        finish_reason = "length" if completion_tokens < settings.completion_tokens else "stop"
+        usage = {
+            "prompt_tokens": accounting["prompt_tokens"],
+            "completion_tokens": completion_tokens,
+            "total_tokens": accounting["prompt_tokens"] + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens}
+        }
+        accounting.update(cached_tokens=cached_tokens, completion_tokens=completion_tokens)
+        words = [ANSWER_WORDS[i % len(ANSWER_WORDS)] + " " for i in range(completion_tokens)]
+        streamed = bool(request.get("stream"))
+        self.server.record(200, accounting, streamed)
+
+        time.sleep(settings.latency * (1 + settings.jitter * (2 * self.server.draw() - 1)))
+        completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+        model = request.get("model", "gpt-4o")
+        if not streamed:
+            if settings.tokens_per_second:
+                time.sleep(completion_tokens / settings.tokens_per_second)
+            self.send_json(200, {
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words)}, "finish_reason": finish_reason}],
+                "usage": usage
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+        try:
+            self.send_event({**chunk, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]})
+            for word in words:
+                if settings.tokens_per_second:
+                    time.sleep(1 / settings.tokens_per_second)
+                self.send_event({**chunk, "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]})
+            self.send_event({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]})
+            if (request.get("stream_options") or {}).get("include_usage"):
+                self.send_event({**chunk, "choices": [], "usage": usage})
+            self.send_chunk(b"data: [DONE]\n\n")
+            self.send_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # 앱이 요청을 취소하면 스트림을 닫음
+            self.close_connection = True
+
+    def authorized(self):
+        """거절할 키면 401을 보내고 False 반환"""
+        if self.headers.get("Authorization", "").removeprefix("Bearer ").startswith(INVALID_KEY_PREFIX):
+            self.server.record(401)
+            self.send_json(401, {"error": {"message": "Incorrect API key provided (mock)", "type": "invalid_request_error", "code": "invalid_api_key"}})
+            return False
+        return True
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_event(self, payload):
+        self.send_chunk(b"data: " + json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n\n")
+
+    def send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+# 서버를 백그라운드 스레드에서 시작 (부하 테스트 등에서 같은 프로세스로 실행할 때)
+def start_server(settings, host="127.0.0.1", port=0):
+    server = MockOpenAIServer((host, port), settings)
+    threading.Thread(target=server.serve_forever, name="mock-openai", daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = MockOpenAIServer((args.host, args.port), args)
+    print(f"목 서버 실행 중: {server.base_url} (집계: http://{args.host}:{server.server_address[1]}/stats)", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.snapshot(), ensure_ascii=False), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,25 +2,36 @@
 # streamlit
 # openai
 # pillow
-# requests
+# numpy
 
 import streamlit as st
-from openai import OpenAI
 import time
 import os
-from PIL import Image
+import hashlib
+import json
+import sqlite3
+import unicodedata
+import re
+import math
+from array import array
+import threading
+from collections import OrderedDict
+from contextlib import closing, suppress
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import uuid
+import atexit
+import heapq
+import bisect
+import itertools
+import random
 import base64
+import tempfile
 from io import BytesIO
-import requests
-import urllib.parse
+from streamlit.logger import get_logger
 
-# 페이지 설정
-st.set_page_config(
-    page_title="어린이 건강 챗봇",
-    page_icon="👶",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
+# 백그라운드 작업 실패 기록용 로거 (화면에는 표시하지 않음)
+logger = get_logger(__name__)
 
 # 블루 계통 머터리얼 디자인 컬러 팔레트
 MATERIAL_COLORS = {
@@ -37,9 +48,10 @@ MATERIAL_COLORS = {
     "error": "#C62828"
 }
 
-# CSS 스타일 적용
-def apply_custom_css():
-    st.markdown(f"""
+# CSS 문자열 생성 (프로세스당 한 번만 만들고, 공백을 줄여 매 실행 전송량을 줄임)
+@st.cache_resource
+def build_custom_css():
+    css = f"""
     <style>
         :root {{
             --primary: {MATERIAL_COLORS['primary']};
@@ -181,7 +193,12 @@ def apply_custom_css():
             margin: 10px 0;
         }}
     </style>
-    """, unsafe_allow_html=True)
+    """
+    return re.sub(r"\s*([{};])\s*", r"\1", re.sub(r"\s+", " ", css)).strip()
+
+# CSS 스타일 적용
+def apply_custom_css():
+    st.markdown(build_custom_css(), unsafe_allow_html=True)
 
 # 향상된 시스템 프롬프트
 SYSTEM_PROMPT = """
@@ -236,6 +253,580 @@ IMAGE_SYSTEM_PROMPT = """
 ⚠️ **중요:** 이미지만으로는 완전한 진단이 불가능하므로, 모든 조언은 "이미지상으로 보이는 증상을 바탕으로 한 추정"임을 명시하고, 정확한 진단을 위해서는 반드시 전문 의료진의 진료를 받도록 안내하세요.
 """
 
+# OpenAI 클라이언트 풀 설정 (환경 변수로 조정 가능)
+CLIENT_POOL_SIZE = int(os.getenv("CLIENT_POOL_SIZE", "32"))
+CLIENT_IDLE_TTL = float(os.getenv("CLIENT_IDLE_TTL", "600"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+# 재시도는 요청 스케줄러가 Retry-After에 맞춰 처리하므로 클라이언트 자체 재시도는 기본으로 끔
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "0"))
+
+# 프로세스 전체에서 공유하는 클라이언트 저장소 (재실행·세션 간 유지)
+@st.cache_resource
+def _client_pool():
+    return {"lock": threading.Lock(), "clients": OrderedDict()}
+
+# API 키별로 재사용되는 OpenAI 클라이언트 반환 함수
+def get_openai_client(api_key):
+    """API 키 해시로 클라이언트를 찾아 keep-alive 연결을 재사용 (키 원문은 저장·기록하지 않음)"""
+    key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    pool = _client_pool()
+    now = time.monotonic()
+    with pool["lock"]:
+        clients = pool["clients"]
+        # 오래 쓰이지 않은 클라이언트 정리 (연결은 참조가 사라지면 닫힘)
+        for stale in [k for k, entry in clients.items() if now - entry["last_used"] > CLIENT_IDLE_TTL]:
+            del clients[stale]
+        entry = clients.get(key_hash)
+        if entry is None:
+            # openai는 무거우므로 인증 후 첫 클라이언트를 만들 때 불러옴
+            from openai import OpenAI, Timeout
+            entry = {
+                "client": OpenAI(
+                    api_key=api_key,
+                    timeout=Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+                    max_retries=OPENAI_MAX_RETRIES
+                ),
+                "last_used": now
+            }
+            clients[key_hash] = entry
+            while len(clients) > CLIENT_POOL_SIZE:
+                clients.popitem(last=False)
+        entry["last_used"] = now
+        clients.move_to_end(key_hash)
+        return entry["client"]
+
+# API 키 운영 방식 (user: 방문자가 키 입력, server: 환경 변수·secrets.toml의 키를 모든 세션이 나눠 씀)
+API_KEY_MODE = os.getenv("API_KEY_MODE", "user")
+API_KEY_PROBE_TTL = float(os.getenv("API_KEY_PROBE_TTL", "3600"))
+# 서버 키 모드의 세션당 한도 (모델 호출 수, 입력+출력 토큰 수, 0이면 제한 없음)
+SESSION_REQUEST_QUOTA = int(os.getenv("SESSION_REQUEST_QUOTA", "30"))
+SESSION_TOKEN_QUOTA = int(os.getenv("SESSION_TOKEN_QUOTA", "100000"))
+
+# 키 확인 결과 저장소 (키 해시 → (유효 여부, 안내 문구, 확인 시각))
+@st.cache_resource
+def _api_key_probes():
+    return {"lock": threading.Lock(), "results": {}}
+
+# API 키 실제 사용 가능 여부 확인 함수
+def probe_api_key(api_key):
+    """토큰을 쓰지 않는 모델 목록 조회로 키를 확인하고, 결과를 키 해시별로 API_KEY_PROBE_TTL 동안 재사용"""
+    key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    probes = _api_key_probes()
+    now = time.monotonic()
+    with probes["lock"]:
+        cached = probes["results"].get(key_hash)
+    if cached is not None and now - cached[2] < API_KEY_PROBE_TTL:
+        return cached[0], cached[1]
+
+    from openai import APIConnectionError, APIStatusError, AuthenticationError
+    try:
+        get_openai_client(api_key).models.list()
+        result = (True, "API 키가 확인되었습니다.")
+    except AuthenticationError:
+        result = (False, "API 키가 유효하지 않습니다. 키를 다시 확인해주세요.")
+    except (APIConnectionError, APIStatusError):
+        # 네트워크·서버 문제나 403(모델 목록 읽기 권한만 없는 제한된 프로젝트 키도 상담은 가능)으로
+        # 확인하지 못한 경우는 저장하지 않고 통과시켜 첫 상담 때 다시 드러나게 함
+        return True, "API 키를 지금 확인하지 못했습니다. 상담 요청 시 다시 확인합니다."
+    with probes["lock"]:
+        probes["results"][key_hash] = (*result, now)
+    return result
+
+# 서버에 설정된 API 키 목록 (OPENAI_API_KEYS 쉼표 구분 > OPENAI_API_KEY > secrets.toml의 openai_api_keys/openai_api_key)
+def configured_server_keys():
+    keys = os.getenv("OPENAI_API_KEYS") or os.getenv("OPENAI_API_KEY") or ""
+    keys = [key.strip() for key in keys.split(",") if key.strip()]
+    if keys:
+        return keys
+    try:
+        secret = st.secrets.get("openai_api_keys") or st.secrets.get("openai_api_key") or []
+    except Exception:
+        # secrets.toml이 없으면 설정된 키 없음
+        return []
+    return [secret] if isinstance(secret, str) else list(secret)
+
+# 확인을 통과한 서버 키 목록 (프로세스당 한 번만 확인)
+@st.cache_resource
+def _server_api_keys():
+    keys = [key for key in configured_server_keys() if validate_api_key(key)[0] and probe_api_key(key)[0]]
+    return {"keys": keys, "next": itertools.count()}
+
+# 새 세션에 서버 키 배정 (여러 개면 돌아가며 배정, 없으면 None)
+def assign_server_api_key():
+    server_keys = _server_api_keys()
+    if not server_keys["keys"]:
+        return None
+    return server_keys["keys"][next(server_keys["next"]) % len(server_keys["keys"])]
+
+# 한도를 넘었을 때 덧붙이는 안내 (사용량은 브라우저 세션에만 있으므로 다시 접속하라고 안내하지 않음)
+QUOTA_EXCEEDED_GUIDANCE = "더 궁금한 점은 가까운 소아청소년과에 문의해주세요.\n\n⚠️ 응급 상황이라면 즉시 119에 신고하거나 가까운 응급실을 방문하세요."
+
+# 이번 세션 사용량 (서버 키 모드 한도 확인용)
+def session_quota_usage():
+    if "quota_used" not in st.session_state:
+        st.session_state.quota_used = {"requests": 0, "tokens": 0}
+    return st.session_state.quota_used
+
+# 세션 한도를 넘었으면 안내 문구 반환 (사용자 키 모드는 제한 없음)
+def session_quota_message():
+    if API_KEY_MODE != "server":
+        return None
+    used = session_quota_usage()
+    if SESSION_REQUEST_QUOTA and used["requests"] >= SESSION_REQUEST_QUOTA:
+        return f"⏳ 이번 접속에서 이용할 수 있는 상담 요청 횟수({SESSION_REQUEST_QUOTA}회)를 모두 사용했습니다.\n\n{QUOTA_EXCEEDED_GUIDANCE}"
+    if SESSION_TOKEN_QUOTA and used["tokens"] >= SESSION_TOKEN_QUOTA:
+        return f"⏳ 이번 접속에서 이용할 수 있는 사용량({SESSION_TOKEN_QUOTA:,}토큰)을 모두 사용했습니다.\n\n{QUOTA_EXCEEDED_GUIDANCE}"
+    return None
+
+# 완료된 모델 호출을 세션 사용량에 반영 (메인 스레드에서 호출, 대화 요약처럼 부가 호출은 토큰만 반영)
+def charge_session_quota(*usages, count_requests=True):
+    used = session_quota_usage()
+    for usage in usages:
+        used["requests"] += count_requests
+        if usage is not None:
+            used["tokens"] += usage.total_tokens
+
+# 요청 스케줄러 설정 (대기열은 프로세스 전체가 함께 쓰고, 분당 한도와 429 일시 정지는 API 키별로 적용)
+SCHEDULER_RPM = int(os.getenv("SCHEDULER_RPM", "500"))
+SCHEDULER_TPM = int(os.getenv("SCHEDULER_TPM", "30000"))
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "50"))
+SCHEDULER_MAX_RETRIES = int(os.getenv("SCHEDULER_MAX_RETRIES", "3"))
+# 이 시간(초) 동안 쓰지 않은 API 키의 한도 정보는 정리
+SCHEDULER_LANE_IDLE = 600
+
+# 요청 우선순위 (숫자가 작을수록 먼저 처리)
+PRIORITY_EMERGENCY = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+# 대기열이 가득 찼을 때 안내 문구
+BUSY_MESSAGE = "⏳ 지금 상담 요청이 많아 접수가 어렵습니다. 잠시 후 다시 시도해주세요.\n\n⚠️ 응급 상황이라면 즉시 119에 신고하거나 가까운 응급실을 방문하세요."
+
+# 대기열이 가득 차 요청을 받을 수 없음을 알리는 예외
+class SchedulerBusy(Exception):
+    pass
+
+# 분당 한도용 토큰 버킷
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount=1):
+        """amount만큼 쌓일 때까지 남은 시간(초), 한도가 0이면 제한 없음 (용량보다 큰 요청은 용량만큼만 기다림)"""
+        if not self.capacity:
+            return 0.0
+        with self.lock:
+            self._refill()
+            return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def take(self, amount=1):
+        if not self.capacity:
+            return
+        with self.lock:
+            self._refill()
+            self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount):
+        """예약했지만 쓰지 않은 양을 돌려줌"""
+        if not self.capacity or amount <= 0:
+            return
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+# API 키 하나의 분당 한도와 429 일시 정지 (대기열은 스케줄러와 공유)
+class SchedulerLane:
+    def __init__(self, scheduler, key):
+        self.scheduler = scheduler
+        self.key = key
+        self.requests = TokenBucket(scheduler.rpm)
+        self.tokens = TokenBucket(scheduler.tpm)
+        self.paused_until = 0.0
+        self.used = time.monotonic()
+
+    def pause(self, seconds):
+        """429를 받으면 같은 키의 요청만 Retry-After 동안 함께 멈춤"""
+        with self.scheduler.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self, tokens, priority=PRIORITY_NORMAL, on_wait=None):
+        self.scheduler._acquire(self, tokens, priority, on_wait)
+
+# 분당 요청·토큰 한도 안에서 우선순위 순서대로 요청을 내보내는 스케줄러
+class RequestScheduler:
+    def __init__(self, rpm, tpm, max_queue):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_queue = max_queue
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.lanes = {}
+        # 키를 지정하지 않은 호출 (배치 실행기처럼 키가 하나뿐인 경우)
+        self.default = self.lane(None)
+
+    def lane(self, key):
+        """키(API 키 해시)별 한도 반환, 오래 쓰지 않은 키는 정리"""
+        with self.condition:
+            lane = self.lanes.get(key)
+            if lane is None:
+                now = time.monotonic()
+                waiting_keys = {ticket[2] for ticket in self.waiting}
+                for idle in [k for k, other in self.lanes.items() if k is not None and k not in waiting_keys and now - other.used > SCHEDULER_LANE_IDLE]:
+                    del self.lanes[idle]
+                lane = self.lanes[key] = SchedulerLane(self, key)
+            lane.used = time.monotonic()
+            return lane
+
+    @property
+    def requests(self):
+        return self.default.requests
+
+    @property
+    def tokens(self):
+        return self.default.tokens
+
+    def pause(self, seconds):
+        self.default.pause(seconds)
+
+    def acquire(self, tokens, priority=PRIORITY_NORMAL, on_wait=None):
+        self._acquire(self.default, tokens, priority, on_wait)
+
+    def _acquire(self, lane, tokens, priority, on_wait):
+        """같은 키 안에서 차례가 오고 한도에 여유가 생길 때까지 기다림, 기다리는 동안 on_wait(앞선 요청 수, 예상 대기 초) 호출"""
+        ticket = (priority, next(self.sequence), lane.key)
+        with self.condition:
+            # 응급 요청은 대기열이 가득 차도 거절하지 않음
+            if len(self.waiting) >= self.max_queue and priority > PRIORITY_EMERGENCY:
+                raise SchedulerBusy()
+            heapq.heappush(self.waiting, ticket)
+        try:
+            while True:
+                with self.condition:
+                    # 다른 키의 요청은 한도를 따로 쓰므로 순서에 넣지 않음
+                    position = sum(1 for other in self.waiting if other[2] == lane.key and other < ticket)
+                    wait_seconds = lane.paused_until - time.monotonic()
+                    if position == 0 and wait_seconds <= 0:
+                        wait_seconds = max(lane.requests.wait_time(1), lane.tokens.wait_time(tokens))
+                        if wait_seconds <= 0:
+                            lane.requests.take(1)
+                            lane.tokens.take(tokens)
+                            return
+                    eta = max(wait_seconds, 0) + (position * 60 / lane.requests.capacity if lane.requests.capacity else 0)
+                # 화면 갱신은 잠금 밖에서 (중간에 재실행되면 finally에서 대기열 정리)
+                if on_wait:
+                    on_wait(position, eta)
+                with self.condition:
+                    self.condition.wait(timeout=min(max(wait_seconds, 0.05), 0.5))
+        finally:
+            with self.condition:
+                if ticket in self.waiting:
+                    self.waiting.remove(ticket)
+                    heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+    def queue_length(self):
+        with self.condition:
+            return len(self.waiting)
+
+# 프로세스 전체에서 공유하는 요청 스케줄러
+@st.cache_resource
+def _request_scheduler():
+    return RequestScheduler(SCHEDULER_RPM, SCHEDULER_TPM, SCHEDULER_MAX_QUEUE)
+
+# 현재 세션의 API 키에 해당하는 스케줄러 한도 (사용자마다 OpenAI 한도가 따로 있으므로)
+def session_scheduler():
+    api_key = st.session_state.get("api_key", "")
+    return _request_scheduler().lane(hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16])
+
+# Retry-After 헤더 해석 함수
+def retry_after_seconds(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            value = headers["retry-after"]
+            try:
+                return float(value)
+            except ValueError:
+                from email.utils import parsedate_to_datetime
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+    return None
+
+# 스케줄러를 거쳐 API를 호출하는 함수
+def call_with_retries(scheduler, create, tokens, priority=PRIORITY_NORMAL, on_wait=None, max_retries=SCHEDULER_MAX_RETRIES, metrics=None):
+    """차례를 받아 호출하고, 일시적 오류는 Retry-After를 따르거나 지터를 준 지수 백오프로 재시도 (metrics가 있으면 대기 시간·재시도 기록)"""
+    from openai import APIConnectionError, InternalServerError, RateLimitError
+    for attempt in range(max_retries + 1):
+        waited = time.perf_counter()
+        scheduler.acquire(tokens, priority, on_wait)
+        if metrics is not None:
+            metrics.observe("chatbot_queue_wait_seconds", time.perf_counter() - waited, priority=priority)
+        try:
+            return create()
+        except (RateLimitError, APIConnectionError, InternalServerError) as e:
+            scheduler.tokens.refund(tokens)
+            # 크레딧·요금 한도 소진은 기다려도 풀리지 않으므로 재시도하지 않음
+            if attempt == max_retries or getattr(e, "code", None) == "insufficient_quota":
+                raise
+            if metrics is not None:
+                metrics.increment("chatbot_retries_total", error=type(e).__name__)
+            delay = retry_after_seconds(e)
+            if delay is None:
+                delay = min(30, 2 ** attempt) * (0.5 + random.random())
+            if isinstance(e, RateLimitError):
+                scheduler.pause(delay)
+            else:
+                time.sleep(delay)
+
+# 실제 사용량을 확인한 뒤 남은 예약 토큰 반환
+def refund_unused_tokens(scheduler, reserved, usage):
+    if usage is not None:
+        scheduler.tokens.refund(reserved - usage.total_tokens)
+
+# 지표 설정 (METRICS_FILE을 지정하면 Prometheus 텍스트 파일로, METRICS_PORT를 지정하면 /metrics 엔드포인트로 내보냄)
+METRICS_FILE = os.getenv("METRICS_FILE", "")
+METRICS_FILE_INTERVAL = float(os.getenv("METRICS_FILE_INTERVAL", "10"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_ADMIN_PANEL = os.getenv("METRICS_ADMIN_PANEL", "0") == "1"
+
+# 히스토그램 구간 (초, 토큰)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+RATIO_BUCKETS = (0, 0.1, 0.25, 0.5, 0.75, 0.9, 1)
+
+# 모델별 100만 토큰당 가격 (USD: 입력, 캐시된 입력, 출력), MODEL_PRICES 환경 변수(JSON)로 덮어쓰기 가능
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    **json.loads(os.getenv("MODEL_PRICES", "{}"))
+}
+
+# 지표 설명 (Prometheus HELP 문구)
+METRIC_HELP = {
+    "chatbot_image_preprocess_seconds": "이미지 디코딩·축소·재인코딩 시간",
+    "chatbot_image_encode_seconds": "이미지 base64 인코딩 시간",
+    "chatbot_queue_wait_seconds": "스케줄러 대기열에서 기다린 시간",
+    "chatbot_ttft_seconds": "호출 시작부터 첫 토큰까지의 시간",
+    "chatbot_api_latency_seconds": "호출 시작부터 응답 완료까지의 시간",
+    "chatbot_prompt_tokens": "요청당 입력 토큰 수",
+    "chatbot_completion_tokens": "요청당 출력 토큰 수",
+    "chatbot_cached_prompt_ratio": "요청당 입력 토큰 중 프롬프트 캐시에서 읽은 비율",
+    "chatbot_tokens_total": "누적 토큰 수",
+    "chatbot_cost_usd_total": "누적 예상 비용(USD)",
+    "chatbot_requests_total": "모델 호출 결과별 요청 수",
+    "chatbot_retries_total": "일시적 오류로 다시 보낸 횟수",
+    "chatbot_cache_hits_total": "모델 호출 없이 저장된 답변을 쓴 횟수"
+}
+
+# 누적 히스토그램 (구간별 개수, 합계, 개수)
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """구간 안에서 선형 보간한 분위수 추정치"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+# 프로세스 내 지표 저장소 (관측마다 잠금 한 번과 이진 탐색 한 번만 수행)
+class MetricsStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        # 지표 파일 저장 스레드와 저장 순서용 잠금 (관측은 막지 않음)
+        self.file_writer = None
+        self.file_lock = threading.Lock()
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def render_prometheus(self):
+        """Prometheus 텍스트 형식으로 변환"""
+        with self.lock:
+            histograms = [(key, list(h.counts), h.sum, h.count, h.buckets) for key, h in self.histograms.items()]
+            counters = list(self.counters.items())
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        def format_labels(labels, extra=()):
+            pairs = [f'{k}="{v}"' for k, v in (*labels, *extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        for (name, labels), counts, total, count, buckets in sorted(histograms, key=lambda item: item[0]):
+            describe(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip((*buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+        for (name, labels), value in sorted(counters):
+            describe(name, "counter")
+            lines.append(f"{name}{format_labels(labels)} {value:.6g}")
+        return "\n".join(lines) + "\n"
+
+# 프로세스 전체에서 공유하는 지표 저장소
+@st.cache_resource
+def _metrics_store():
+    return MetricsStore()
+
+# 예상 비용 계산 함수
+def estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    input_price, cached_price, output_price = prices
+    return ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price + completion_tokens * output_price) / 1_000_000
+
+# 사용량 정보의 캐시된 입력 토큰 수 (모델·서버가 알려주지 않으면 0)
+def cached_prompt_tokens(usage):
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) or 0
+
+# 여러 호출을 합친 입력 토큰 중 캐시된 비율 (사용량 정보가 없으면 None)
+def cached_prompt_ratio(*usages):
+    usages = [usage for usage in usages if usage is not None and usage.prompt_tokens]
+    if not usages:
+        return None
+    return sum(cached_prompt_tokens(usage) for usage in usages) / sum(usage.prompt_tokens for usage in usages)
+
+# 모델 호출 한 건의 지연시간·토큰·비용 기록 함수
+def record_completion(metrics, model, latency, ttft=None, usage=None, outcome="ok", route="default"):
+    write_metrics_file(metrics)
+    metrics.increment("chatbot_requests_total", model=model, route=route, outcome=outcome)
+    metrics.observe("chatbot_api_latency_seconds", latency, model=model, route=route)
+    if ttft is not None:
+        metrics.observe("chatbot_ttft_seconds", ttft, model=model, route=route)
+    if usage is None:
+        return
+    cached_tokens = cached_prompt_tokens(usage)
+    metrics.observe("chatbot_prompt_tokens", usage.prompt_tokens, TOKEN_BUCKETS, model=model)
+    if usage.prompt_tokens:
+        metrics.observe("chatbot_cached_prompt_ratio", cached_tokens / usage.prompt_tokens, RATIO_BUCKETS, model=model, route=route)
+    metrics.observe("chatbot_completion_tokens", usage.completion_tokens, TOKEN_BUCKETS, model=model)
+    metrics.increment("chatbot_tokens_total", usage.prompt_tokens - cached_tokens, model=model, type="prompt")
+    metrics.increment("chatbot_tokens_total", cached_tokens, model=model, type="cached")
+    metrics.increment("chatbot_tokens_total", usage.completion_tokens, model=model, type="completion")
+    cost = estimate_cost(model, usage.prompt_tokens, usage.completion_tokens, cached_tokens)
+    if cost is not None:
+        metrics.increment("chatbot_cost_usd_total", cost, model=model)
+
+# 지표 파일 저장 함수 (요청 경로에서는 저장 스레드만 시작하고, force이면 바로 저장)
+def write_metrics_file(metrics, force=False):
+    if not METRICS_FILE:
+        return
+    if force:
+        _write_metrics_file(metrics)
+        return
+    with metrics.lock:
+        if metrics.file_writer is None:
+            metrics.file_writer = threading.Thread(target=_metrics_file_loop, args=(metrics,), name="metrics-file", daemon=True)
+            metrics.file_writer.start()
+
+# METRICS_FILE_INTERVAL마다 지표 파일을 다시 쓰는 저장 스레드
+def _metrics_file_loop(metrics):
+    while True:
+        _write_metrics_file(metrics)
+        time.sleep(METRICS_FILE_INTERVAL)
+
+# 지표 파일 한 번 저장 (node_exporter textfile 수집기 등에서 읽을 수 있도록 원자적으로 교체)
+def _write_metrics_file(metrics):
+    """저장에 실패해도 상담에는 영향을 주지 않도록 기록만 남김"""
+    body = metrics.render_prometheus()
+    temp_path = None
+    try:
+        with metrics.file_lock:
+            # 동시에 저장해도 서로의 임시 파일을 덮어쓰지 않도록 임시 파일 이름을 매번 새로 만듦
+            fd, temp_path = tempfile.mkstemp(prefix=f"{os.path.basename(METRICS_FILE)}.", suffix=".tmp", dir=os.path.dirname(METRICS_FILE) or ".")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(body)
+            # mkstemp는 소유자만 읽을 수 있게 만들므로 수집기가 읽을 수 있도록 권한을 넓힘
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, METRICS_FILE)
+    except OSError:
+        logger.warning("지표 파일 %s 저장에 실패했습니다.", METRICS_FILE, exc_info=True)
+        if temp_path is not None:
+            with suppress(OSError):
+                os.remove(temp_path)
+
+# /metrics 엔드포인트 서버 (METRICS_PORT를 지정했을 때 프로세스당 한 번만 시작)
+@st.cache_resource
+def _metrics_server():
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    metrics = _metrics_store()
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", METRICS_PORT), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
 # API 키 검증 함수
 def validate_api_key(api_key):
     if not api_key:
@@ -254,114 +845,1509 @@ def show_loading_bar(progress, placeholder):
     </div>
     """, unsafe_allow_html=True)
 
-# 이미지를 base64로 인코딩하는 함수
-def encode_image_to_base64(uploaded_file):
-    """업로드된 이미지를 base64로 인코딩"""
+# 이미지 전처리 설정 (환경 변수로 조정 가능)
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1536"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+IMAGE_LOW_DETAIL_EDGE = 512
+IMAGE_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+# 여러 장 첨부 설정 (요청 하나에 담는 최대 사진 수, 요청당 예상 이미지 토큰 예산, 병렬 처리 작업자 수)
+MAX_UPLOAD_IMAGES = int(os.getenv("MAX_UPLOAD_IMAGES", "4"))
+IMAGE_TOKEN_BUDGET = int(os.getenv("IMAGE_TOKEN_BUDGET", "3000"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(4, os.cpu_count() or 1))))
+THUMBNAIL_EDGE = 160
+
+# 비전 모델 이미지 토큰 추정 함수
+def estimate_image_tokens(width, height, detail):
+    """GPT-4o 기준 이미지 토큰 수 추정 (low: 고정 85, high: 512px 타일당 170 + 85)"""
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = -(-int(width) // 512) * -(-int(height) // 512)
+    return 170 * tiles + 85
+
+# 이미지 전처리 함수
+def preprocess_image(image_bytes, max_edge=IMAGE_MAX_EDGE):
+    """한 번만 디코딩하여 EXIF 회전 적용, 메타데이터 제거, 크기 축소 후 재인코딩"""
+    from PIL import Image, ImageOps
+    with Image.open(BytesIO(image_bytes)) as image:
+        # JPEG는 디코딩 단계에서 바로 축소 (필요한 크기 이상으로만 줄어듦)
+        image.draft("RGB", (max_edge, max_edge))
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        output = BytesIO()
+        # EXIF 등 메타데이터는 넘기지 않으므로 저장 시 모두 제거됨
+        image.save(output, format=IMAGE_FORMAT, quality=IMAGE_QUALITY, optimize=True)
+        return output.getvalue(), IMAGE_MIME_TYPES[IMAGE_FORMAT], image.size
+
+# 이미지 바이트를 data URL로 인코딩하는 함수 (Streamlit 없이도 사용 가능)
+def encode_image_bytes(image_bytes, metrics=None, max_edge=IMAGE_MAX_EDGE):
+    """전처리 후 base64 data URL로 인코딩하고 절감량·토큰 추정치·단계별 소요 시간을 함께 반환"""
+    started = time.perf_counter()
+    encoded_bytes, mime_type, (width, height) = preprocess_image(image_bytes, max_edge)
+    preprocessed = time.perf_counter()
+    detail = "low" if max(width, height) <= IMAGE_LOW_DETAIL_EDGE else "high"
+    base64_image = base64.b64encode(encoded_bytes).decode('utf-8')
+    encoded = time.perf_counter()
+    if metrics is not None:
+        metrics.observe("chatbot_image_preprocess_seconds", preprocessed - started)
+        metrics.observe("chatbot_image_encode_seconds", encoded - preprocessed)
+    stats = {
+        "original_bytes": len(image_bytes),
+        "encoded_bytes": len(encoded_bytes),
+        "saved_bytes": len(image_bytes) - len(encoded_bytes),
+        "width": width,
+        "height": height,
+        "detail": detail,
+        "estimated_tokens": estimate_image_tokens(width, height, detail),
+        "preprocess_seconds": preprocessed - started,
+        "encode_seconds": encoded - preprocessed
+    }
+    return {"url": f"data:{mime_type};base64,{base64_image}", "detail": detail, "stats": stats}
+
+# 사진 처리용 작업자 풀 (PIL 디코딩·축소와 해시 계산은 GIL을 놓으므로 스레드로 병렬 처리)
+@st.cache_resource
+def _image_executor():
+    return ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+# 사진들의 예상 이미지 토큰 합계
+def total_image_tokens(encoded_images):
+    return sum(image["stats"]["estimated_tokens"] for image in encoded_images)
+
+# 여러 사진을 인코딩하는 함수 (Streamlit 없이도 사용 가능)
+def encode_images(images, metrics=None, executor=None, token_budget=IMAGE_TOKEN_BUDGET):
+    """사진마다 전처리·인코딩을 병렬로 실행하고, 예상 이미지 토큰 합이 예산을 넘으면 토큰이 큰 사진부터 저해상도로 다시 인코딩"""
+    run = executor.map if executor else map
+    encoded = list(run(lambda data: encode_image_bytes(data, metrics), images))
+    excess = total_image_tokens(encoded) - token_budget
+    downgrade = []
+    for i in sorted(range(len(encoded)), key=lambda i: -encoded[i]["stats"]["estimated_tokens"]):
+        if excess <= 0:
+            break
+        if encoded[i]["detail"] != "low":
+            downgrade.append(i)
+            excess -= encoded[i]["stats"]["estimated_tokens"] - estimate_image_tokens(0, 0, "low")
+    for i, image in zip(downgrade, run(lambda i: encode_image_bytes(images[i], metrics, IMAGE_LOW_DETAIL_EDGE), downgrade)):
+        encoded[i] = image
+    return encoded
+
+# 업로드된 파일 내용 읽기 함수
+def read_uploaded_file(uploaded_file):
+    # 파일을 다시 읽기 위해 포인터를 처음으로 이동
+    uploaded_file.seek(0)
+    return uploaded_file.read()
+
+# 업로드된 사진들을 base64로 인코딩하는 함수
+def encode_uploaded_images(uploaded_files):
+    """업로드된 사진들을 병렬로 전처리 후 base64 data URL로 인코딩하고 사진별 절감량·토큰 추정치를 함께 기록"""
     try:
-        # 파일을 다시 읽기 위해 포인터를 처음으로 이동
-        uploaded_file.seek(0)
-        # 이미지를 바이트로 읽고 base64로 인코딩
-        image_bytes = uploaded_file.read()
-        base64_image = base64.b64encode(image_bytes).decode('utf-8')
-        return base64_image
+        encoded_images = encode_images(
+            [read_uploaded_file(uploaded_file) for uploaded_file in uploaded_files], _metrics_store(), _image_executor()
+        )
+        st.session_state.last_image_stats = [image["stats"] for image in encoded_images]
+        return encoded_images
     except Exception as e:
         st.error(f"이미지 인코딩 중 오류가 발생했습니다: {str(e)}")
         return None
 
+# 미리보기 썸네일 생성 함수 (내용 해시별로 한 번만 디코딩)
+@st.cache_resource(max_entries=256)
+def image_thumbnail(image_hash, _uploaded_file):
+    from PIL import Image, ImageOps
+    with Image.open(BytesIO(read_uploaded_file(_uploaded_file))) as image:
+        image.draft("RGB", (THUMBNAIL_EDGE * 2, THUMBNAIL_EDGE * 2))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((THUMBNAIL_EDGE * 2, THUMBNAIL_EDGE * 2))
+        output = BytesIO()
+        image.convert("RGB").save(output, format="JPEG", quality=80)
+        return output.getvalue()
+
+# 스트리밍 응답 렌더링 간격(초) - 토큰마다 다시 그리지 않도록 제한
+STREAM_RENDER_INTERVAL = 0.05
+
+# 응답 말풍선 HTML 생성 함수
+def render_bot_bubble(content, cursor=False):
+    return f'<div class="chat-message bot"><strong>🩺 챗봇 상담:</strong><br>{content}{"▌" if cursor else ""}</div>'
+
+# 대기열 순서 안내 문구
+def format_queue_wait(position, eta):
+    return f"⏳ 요청이 많아 순서를 기다리고 있습니다. 앞선 요청 {position}건 · 예상 대기 약 {eta:.0f}초"
+
+# 시스템 프롬프트가 모든 답변 끝에 요구하는 면책 문구
+MEDICAL_DISCLAIMER = "이 정보는 참고용이며, 정확한 진단과 치료는 반드시 전문 의료진의 진료를 받아야 합니다."
+# 답변 길이 한도(max_tokens)에 걸려 끊긴 답변 끝에 붙이는 안내
+TRUNCATED_ANSWER_NOTE = "⚠️ 답변이 길어 중간에 끊겼습니다. 궁금한 부분을 나눠서 다시 질문해주세요."
+
+# 끊긴 답변 마무리 함수
+def finish_truncated_answer(content):
+    """끊기면서 빠진 면책 문구를 안내와 함께 덧붙임"""
+    return f"{content.rstrip()}\n\n{TRUNCATED_ANSWER_NOTE}\n\n{MEDICAL_DISCLAIMER}"
+
+# 채팅 완성 API 호출 함수 (스트리밍/일반 공용)
+def request_chat_completion(client, model, messages, max_tokens, temperature, priority=PRIORITY_NORMAL, prompt_tokens=None, route="default"):
+    """공용 스케줄러에서 차례를 받아 호출하고, 스트리밍 모드면 토큰을 받는 대로 말풍선에 그리며 첫 토큰까지의 시간(TTFT)을 기록 (max_tokens에서 끊긴 답변은 last_truncated를 켜고 면책 문구를 붙여 반환)"""
+    scheduler = session_scheduler()
+    metrics = _metrics_store()
+    reserved = (prompt_tokens or count_message_tokens(messages)) + max_tokens
+    streaming = st.session_state.get("streaming", True)
+    queue_placeholder = st.empty()
+    started = None
+
+    def create():
+        nonlocal started
+        queue_placeholder.empty()
+        started = time.perf_counter()
+        if not streaming:
+            return client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature
+            )
+        return client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+
+    def show_queue_wait(position, eta):
+        queue_placeholder.info(format_queue_wait(position, eta))
+
+    try:
+        result = call_with_retries(scheduler, create, reserved, priority, show_queue_wait, metrics=metrics)
+    except Exception:
+        metrics.increment("chatbot_requests_total", model=model, route=route, outcome="error")
+        raise
+    finally:
+        queue_placeholder.empty()
+    if not streaming:
+        refund_unused_tokens(scheduler, reserved, result.usage)
+        st.session_state.last_latency = time.perf_counter() - started
+        st.session_state.last_cached_ratio = cached_prompt_ratio(result.usage)
+        st.session_state.last_truncated = result.choices[0].finish_reason == "length"
+        charge_session_quota(result.usage)
+        record_completion(
+            metrics, model, st.session_state.last_latency, usage=result.usage,
+            outcome="truncated" if st.session_state.last_truncated else "ok", route=route
+        )
+        content = result.choices[0].message.content
+        return finish_truncated_answer(content or "") if st.session_state.last_truncated else content
+
+    # 재실행(StopException) 등으로 중간에 멈춰도 연결과 서버 쪽 생성을 바로 끝냄
+    with closing(result):
+        progress_placeholder = st.empty()
+        answer_placeholder = st.empty()
+        show_loading_bar(0, progress_placeholder)
+        try:
+            parts = []
+            received = 0
+            last_render = 0.0
+            usage = finish_reason = None
+            for chunk in result:
+                if getattr(chunk, "usage", None) is not None:
+                    usage = chunk.usage
+                    refund_unused_tokens(scheduler, reserved, usage)
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                if st.session_state.last_ttft is None:
+                    st.session_state.last_ttft = time.perf_counter() - started
+                parts.append(delta)
+                # 청크 하나가 대략 토큰 하나이므로 max_tokens 대비 실제 진행률로 표시
+                received += 1
+                now = time.perf_counter()
+                if now - last_render >= STREAM_RENDER_INTERVAL:
+                    show_loading_bar(min(99, received * 100 // max_tokens), progress_placeholder)
+                    answer_placeholder.markdown(render_bot_bubble("".join(parts), cursor=True), unsafe_allow_html=True)
+                    last_render = now
+            st.session_state.last_latency = time.perf_counter() - started
+            st.session_state.last_cached_ratio = cached_prompt_ratio(usage)
+            st.session_state.last_truncated = finish_reason == "length"
+            charge_session_quota(usage)
+            record_completion(
+                metrics, model, st.session_state.last_latency, st.session_state.last_ttft, usage,
+                outcome="truncated" if st.session_state.last_truncated else "ok", route=route
+            )
+            return finish_truncated_answer("".join(parts)) if st.session_state.last_truncated else "".join(parts)
+        finally:
+            progress_placeholder.empty()
+            answer_placeholder.empty()
+
+# 응답 캐시 설정 (RESPONSE_CACHE_DB를 지정하면 SQLite 디스크 캐시도 사용)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB", "")
+RESPONSE_CACHE_DB_MAX_ROWS = int(os.getenv("RESPONSE_CACHE_DB_MAX_ROWS", "10000"))
+
+# 프로세스 전체에서 공유하는 응답 캐시 (메모리 LRU + 선택적 SQLite)
+@st.cache_resource
+def _response_cache():
+    cache = {"lock": threading.Lock(), "entries": OrderedDict(), "hits": 0, "misses": 0, "db": None}
+    if RESPONSE_CACHE_DB:
+        db = sqlite3.connect(RESPONSE_CACHE_DB, check_same_thread=False)
+        db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, content TEXT NOT NULL, created REAL NOT NULL)")
+        db.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses (created)")
+        db.commit()
+        cache["db"] = db
+    return cache
+
+# 증상 텍스트 정규화 함수
+def normalize_symptoms(text):
+    """유니코드 정규화, 공백 정리, 소문자 변환으로 같은 질문을 같은 키로 묶음"""
+    return " ".join(unicodedata.normalize("NFC", text).split()).lower()
+
+# 업로드 사진 내용 해시 함수
+def image_content_hashes(uploaded_files):
+    """업로드마다 한 번만 계산해 세션에 기억하고 (재실행마다 다시 읽지 않음), 새로 올린 사진들은 병렬로 해시"""
+    known = st.session_state.setdefault("image_hashes", {})
+    missing = [f for f in uploaded_files if getattr(f, "file_id", None) not in known]
+    digests = _image_executor().map(lambda f: hashlib.sha256(read_uploaded_file(f)).hexdigest(), missing)
+    computed = dict(zip(map(id, missing), digests))
+    for uploaded_file in missing:
+        if getattr(uploaded_file, "file_id", None) is not None:
+            known[uploaded_file.file_id] = computed[id(uploaded_file)]
+    return [computed.get(id(f)) or known[f.file_id] for f in uploaded_files]
+
+# 여러 사진의 내용 해시 함수 (한 장이면 그 사진의 해시, 여러 장이면 순서대로 합친 해시)
+def images_content_hash(uploaded_files):
+    hashes = image_content_hashes(uploaded_files)
+    if len(hashes) == 1:
+        return hashes[0]
+    return hashlib.sha256("".join(hashes).encode("utf-8")).hexdigest()
+
+# 응답 캐시 키 생성 함수
+def make_cache_key(system_prompt, symptoms, image_hash, model, temperature, max_tokens, context=()):
+    payload = json.dumps(
+        [system_prompt, normalize_symptoms(symptoms), image_hash, model, temperature, max_tokens, list(context)],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# 캐시 조회 함수
+def cache_get(key):
+    """메모리 → 디스크 순으로 조회하고, 디스크에서 찾으면 메모리로 올림"""
+    cache = _response_cache()
+    now = time.time()
+    with cache["lock"]:
+        entry = cache["entries"].get(key)
+        if entry and now - entry["created"] <= RESPONSE_CACHE_TTL:
+            cache["entries"].move_to_end(key)
+            cache["hits"] += 1
+            return entry["content"]
+        if entry:
+            del cache["entries"][key]
+        if cache["db"] is not None:
+            row = cache["db"].execute(
+                "SELECT content, created FROM responses WHERE key = ? AND created >= ?",
+                (key, now - RESPONSE_CACHE_TTL)
+            ).fetchone()
+            if row:
+                _cache_put_memory(cache, key, row[0], row[1])
+                cache["hits"] += 1
+                return row[0]
+        cache["misses"] += 1
+        return None
+
+def _cache_put_memory(cache, key, content, created):
+    cache["entries"][key] = {"content": content, "created": created}
+    cache["entries"].move_to_end(key)
+    while len(cache["entries"]) > RESPONSE_CACHE_SIZE:
+        cache["entries"].popitem(last=False)
+
+# 캐시 저장 함수
+def cache_put(key, content):
+    cache = _response_cache()
+    now = time.time()
+    with cache["lock"]:
+        _cache_put_memory(cache, key, content, now)
+        if cache["db"] is not None:
+            db = cache["db"]
+            db.execute("INSERT OR REPLACE INTO responses (key, content, created) VALUES (?, ?, ?)", (key, content, now))
+            # 만료된 항목과 한도를 넘는 오래된 항목 정리
+            db.execute("DELETE FROM responses WHERE created < ?", (now - RESPONSE_CACHE_TTL,))
+            db.execute(
+                "DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY created DESC LIMIT ?)",
+                (RESPONSE_CACHE_DB_MAX_ROWS,)
+            )
+            db.commit()
+
+# 캐시 적중 통계 반환 함수
+def response_cache_stats():
+    cache = _response_cache()
+    with cache["lock"]:
+        return {"hits": cache["hits"], "misses": cache["misses"], "size": len(cache["entries"])}
+
+# 응급 신호 분류 (응급도, 안내 문구, 띄어쓰기를 뺀 위험 표현 목록)
+# 위험 표현은 어절 첫머리에서 시작할 때만 인정함 ("기침하고 열이"의 "고 열"을 "고열"로 읽지 않도록)
+# "-"로 시작하는 표현은 "열성경련", "세탁세제를"처럼 앞 낱말과 붙여 쓴 합성어 안에서도 인정함
+DANGER_SIGNS = {
+    "breathing": ("emergency", "숨쉬기 힘들어하거나 숨이 가쁘면 즉시 119에 신고하세요.", [
+        "호흡곤란", "호흡이힘들", "호흡하기힘들", "호흡이어려", "호흡이빠르", "호흡이빨라", "호흡이너무빠르", "호흡이너무빨라",
+        "호흡이가쁘", "호흡이가빠", "숨이가쁘", "숨이가빠", "숨을가쁘게", "숨을못쉬", "숨을안쉬", "숨을잘못쉬",
+        "숨쉬기힘들", "숨쉬기어려", "숨쉬기가힘들", "숨쉬기가어려", "숨을쉬기힘들", "숨을쉬기어려", "숨을쉬기가힘들",
+        "숨쉬는게힘들", "숨쉬는게어려", "숨쉬는걸힘들", "숨쉬는것이힘들", "숨을쉬는게힘들", "숨쉬는게빨라", "숨쉬는게너무빨",
+        "숨을빨리쉬", "숨이차", "숨을헐떡", "숨을몰아쉬", "숨이막히", "숨이막혀", "숨이막힌", "쌕쌕",
+        "갈비뼈가쏙", "갈비뼈가쑥", "갈비뼈사이가들어", "갈비뼈사이가쏙", "갈비뼈사이가쑥", "가슴이쑥들어", "가슴이쏙들어"
+    ]),
+    "consciousness": ("emergency", "깨워도 잘 깨지 않거나 축 처지면 즉시 119에 신고하세요.", [
+        "의식저하", "의식이없", "의식을잃", "정신을잃", "기절", "쓰러졌", "쓰러져", "쓰러지", "반응이없",
+        "깨워도안깨", "깨워도잘안깨", "깨워도깨지않", "깨워도안일어나", "깨워도잘안일어나", "깨워도일어나지않",
+        "깨워도잘일어나지않", "깨워도못일어나", "깨우기가힘들", "깨우기힘들", "깨우기가어려", "깨우기어려",
+        "축처지", "축처져", "축늘어"
+    ]),
+    "seizure": ("emergency", "경련 중에는 아이를 옆으로 눕히고 입에 아무것도 넣지 마세요. 5분 이상 계속되거나 처음 겪는 경련이면 즉시 119에 신고하세요.", [
+        "-경련", "발작을", "발작했", "발작이", "경기를했", "경기를일으", "경기했", "경기를해",
+        "눈이돌아가", "눈이돌아갔", "눈이뒤집", "몸이뻣뻣하게굳", "몸이굳"
+    ]),
+    "cyanosis": ("emergency", "입술이나 얼굴이 파랗게 변하면 즉시 119에 신고하세요.", [
+        "청색증", "입술이파랗", "입술이파래", "입술이새파", "입술이보라", "입술색이파", "입술색이보라",
+        "얼굴이파랗", "얼굴이파래", "얼굴이새파"
+    ]),
+    "choking": ("emergency", "목에 무언가 걸려 숨을 못 쉬면 즉시 119에 신고하고 안내에 따라 하임리히법을 시행하세요.", [
+        "목에걸려", "목에걸렸", "목에걸린", "목에뭐가걸", "기도가막", "질식"
+    ]),
+    "poisoning": ("urgent", "약·세제·건전지·자석 등을 삼켰다면 억지로 토하게 하지 말고 즉시 119 또는 응급실에 연락하세요.", [
+        "약을삼켰", "약을먹어버", "약을여러알", "약을한통", "약을통째로", "한통을다먹", "여러알을먹", "여러알먹",
+        "혈압약을먹", "수면제를먹", "어른약을먹", "-세제를마", "-세제를먹", "-건전지를삼", "-건전지를먹",
+        "자석을삼", "이물질을삼", "담배를먹", "담배를삼", "담배꽁초를", "락스를"
+    ]),
+    "bleeding": ("urgent", "피를 토하거나 피가 멈추지 않으면 즉시 응급실로 가세요.", [
+        "피를토", "토혈", "혈변", "피가섞인변", "피가섞여나", "토한것에피", "변에피가섞",
+        "-피가멈추지않", "-피가안멈", "피가계속나", "출혈이심"
+    ]),
+    "allergy": ("urgent", "얼굴·입술·혀가 붓거나 온몸에 두드러기가 퍼지면 즉시 응급실로 가세요.", [
+        "아나필락시스", "입술이붓", "입술이부었", "입술이부어", "혀가붓", "혀가부었", "혀가부어",
+        "얼굴이붓", "얼굴이부었", "얼굴이부어"
+    ]),
+    "head_injury": ("urgent", "머리를 세게 부딪힌 뒤 구토하거나 처지면 즉시 응급실로 가세요.", [
+        "머리를세게", "머리부터떨어", "머리를크게다", "머리를박았"
+    ]),
+    "dehydration": ("urgent", "소변이 크게 줄거나 울어도 눈물이 나지 않으면 탈수일 수 있으니 바로 병원에 가세요.", [
+        "소변을안", "소변이안나", "소변을거의안", "소변이거의안", "소변을하루종일안", "눈물이안나", "입이바짝마르", "탈수"
+    ]),
+    "meningitis": ("urgent", "목이 뻣뻣하거나 눌러도 사라지지 않는 붉은 반점이 있으면 즉시 응급실로 가세요.", [
+        "목이뻣뻣", "목을앞으로못숙", "목을못숙", "고개를못숙", "눌러도안없어", "눌러도사라지지않"
+    ]),
+    "high_fever": ("urgent", "고열이 계속되거나 해열제에도 떨어지지 않으면 바로 병원 진료를 받으세요.", [
+        "고열", "해열제를먹여도안떨어", "해열제먹여도안떨어", "해열제를먹였는데도안", "해열제먹였는데도안",
+        "먹여도열이안떨어", "먹여도열이안내려", "먹여도열이그대로", "먹였는데도열이안", "먹였는데도열이그대로"
+    ])
+}
+
+# 체온 기준 (℃)
+URGENT_FEVER = 40.0
+INFANT_FEVER = 38.0
+INFANT_MONTHS = 3
+
+# 위험 표현 바로 뒤에 붙어 있을 때만 부정으로 보는 표현 (예: "경련은 없었어요", "숨이 차지는 않아요", "혈변은 안 보였어요")
+NEGATION_PATTERN = re.compile(r"[은는이가을를도]?(?:(?:거리|대|어하|하|했)?지[는도]?않|없|아니|(?:안|못)(?:했|해|하|보|봤|나|났))")
+# 부정 표현을 찾는 범위 (위험 표현이 끝난 어절과 다음 두 어절, 문장이 끝나면 멈춤)
+NEGATION_WORDS = 3
+SENTENCE_BOUNDARY = re.compile(r"[.!?,;\n]")
+
+FEVER_PATTERN = re.compile(r"(\d{2}(?:\.\d)?)\s*(?:도|℃|°c|°)")
+# 월령 표현 (생후, 된, 아기 등 나이를 뜻하는 말이 붙을 때만 나이로 봄, "3일째", "2일 전부터" 같은 기간은 제외)
+AGE_PATTERN = re.compile(r"(생후\s*)?(\d+|(?:(?<![가-힣])|(?<=생후))(?:한|두|세|석|네|넉))\s*(개월|달|주일|주|일)\s*(된\s*)?(아기|아이|영아|신생아)?")
+AGE_UNIT_MONTHS = {"개월": 1, "달": 1, "주일": 4.3, "주": 4.3, "일": 30}
+AGE_NUMBER_WORDS = {"한": 1, "두": 2, "세": 3, "석": 3, "네": 4, "넉": 4}
+
+# 다중 패턴 검색기(Aho-Corasick) 생성 함수
+def build_phrase_matcher(phrases_by_label):
+    """표현 목록을 한 번에 검색할 수 있는 오토마톤(전이표, 실패 링크, 출력) 생성"""
+    transitions, fail, outputs = [{}], [0], [[]]
+    for label, phrases in phrases_by_label.items():
+        for phrase in phrases:
+            state = 0
+            for ch in phrase:
+                if ch not in transitions[state]:
+                    transitions.append({})
+                    fail.append(0)
+                    outputs.append([])
+                    transitions[state][ch] = len(transitions) - 1
+                state = transitions[state][ch]
+            outputs[state].append((label, len(phrase)))
+    pending = list(transitions[0].values())
+    while pending:
+        state = pending.pop(0)
+        for ch, next_state in transitions[state].items():
+            pending.append(next_state)
+            fallback = fail[state]
+            while fallback and ch not in transitions[fallback]:
+                fallback = fail[fallback]
+            fail[next_state] = transitions[fallback].get(ch, 0)
+            outputs[next_state] = outputs[next_state] + outputs[fail[next_state]]
+    return transitions, fail, outputs
+
+# 다중 패턴 검색 함수
+def match_phrases(matcher, text):
+    """텍스트를 한 번 훑으며 (라벨, 시작 위치, 끝 위치) 목록 반환"""
+    transitions, fail, outputs = matcher
+    state, matches = 0, []
+    for end, ch in enumerate(text, 1):
+        while state and ch not in transitions[state]:
+            state = fail[state]
+        state = transitions[state].get(ch, 0)
+        for label, length in outputs[state]:
+            matches.append((label, end - length, end))
+    return matches
+
+# 위험 표현 검색기 (재실행마다 다시 만들지 않도록 프로세스당 한 번만 생성)
+# (라벨, 합성어 안에서도 인정하는지)를 검색기 라벨로 사용
+@st.cache_resource
+def _danger_sign_matcher():
+    phrases_by_label = {}
+    for label, (_, _, phrases) in DANGER_SIGNS.items():
+        for phrase in phrases:
+            phrases_by_label.setdefault((label, phrase.startswith("-")), []).append(phrase.lstrip("-"))
+    return build_phrase_matcher(phrases_by_label)
+
+# 나이 숫자 변환 함수 ("2", "두" 모두 지원)
+def age_number(value):
+    return AGE_NUMBER_WORDS[value] if value in AGE_NUMBER_WORDS else int(value)
+
+# 월령 표현인지 확인하는 함수
+def is_age_mention(match):
+    """생후로 시작하거나 아기·신생아 등이 붙은 경우만 나이로 봄 (N주·N일은 기간으로 더 흔히 쓰이므로 "아이"만 붙으면 "된"까지 있어야 함)"""
+    after_birth, _, unit, became, noun = match.groups()
+    if after_birth or noun in ("아기", "영아", "신생아"):
+        return True
+    if unit in ("개월", "달"):
+        return bool(became or noun)
+    return bool(became and noun)
+
+# 응급 신호 분류 함수
+def triage_symptoms(text):
+    """모델 호출 없이 위험 표현과 체온·월령으로 응급도를 판단해 {"level", "signs", "guidance", "fever"} 반환"""
+    normalized = normalize_symptoms(text)
+    compact = "".join(normalized.split())
+    # 띄어쓰기를 뺀 위치를 원래 문장 위치로 되돌리는 표 (부정 표현 범위를 어절 단위로 자르기 위해)
+    offsets = [i for i, ch in enumerate(normalized) if not ch.isspace()]
+    signs = []
+    for (label, inside_word), start, end in match_phrases(_danger_sign_matcher(), compact):
+        if label in signs:
+            continue
+        if not inside_word and offsets[start] > 0 and normalized[offsets[start] - 1].isalnum():
+            continue
+        clause = SENTENCE_BOUNDARY.split(normalized[offsets[end - 1] + 1:], maxsplit=1)[0]
+        following = "".join(clause.split(" ")[:NEGATION_WORDS])
+        if not NEGATION_PATTERN.match(following):
+            signs.append(label)
+
+    fever = max((float(value) for value in FEVER_PATTERN.findall(normalized) if 34 <= float(value) <= 43), default=None)
+    guidance = [DANGER_SIGNS[label][1] for label in signs]
+    levels = [DANGER_SIGNS[label][0] for label in signs]
+    if fever is not None:
+        age_months = next((age_number(age.group(2)) / AGE_UNIT_MONTHS[age.group(3)] for age in AGE_PATTERN.finditer(normalized) if is_age_mention(age)), None)
+        if age_months is not None and age_months < INFANT_MONTHS and fever >= INFANT_FEVER:
+            signs.append("infant_fever")
+            levels.append("emergency")
+            guidance.append(f"생후 {INFANT_MONTHS}개월 미만 아기가 {INFANT_FEVER:.0f}도 이상 열이 나면 즉시 응급실로 가세요.")
+        elif fever >= URGENT_FEVER:
+            signs.append("very_high_fever")
+            levels.append("urgent")
+            guidance.append(f"{URGENT_FEVER:.0f}도 이상 고열이면 바로 병원(응급실) 진료를 받으세요.")
+
+    level = "emergency" if "emergency" in levels else "urgent" if levels else None
+    return {"level": level, "signs": signs, "guidance": guidance, "fever": fever}
+
+# 응급 신호 포함 여부 확인 함수
+def is_emergency(text):
+    return triage_symptoms(text)["level"] is not None
+
+# 응급 안내 표시 함수
+def render_triage_alert(triage):
+    title = "🚨 응급 신호가 보입니다. 지금 바로 119에 신고하세요." if triage["level"] == "emergency" else "⚠️ 바로 병원 진료가 필요할 수 있는 신호가 보입니다."
+    st.error("\n".join([f"**{title}**"] + [f"- {line}" for line in triage["guidance"]] + ["", "아래 상담 답변은 참고용이며, 응급 조치가 우선입니다."]))
+
+# 유사 질문 캐시 설정
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+SEMANTIC_NGRAM_SIZES = (2, 3)
+# 글자 대부분이 같아도 부정 표현이나 숫자(나이·체온·횟수)가 다르면 반대 뜻일 수 있으므로 재사용하지 않음
+SEMANTIC_NEGATION_PATTERN = re.compile(r"(?:^|\s)(?:안|못)|않|없|아니|말고")
+SEMANTIC_NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)?")
+
+# 시스템 프롬프트별 유사 질문 색인 (문자 n-gram TF-IDF 역색인)
+@st.cache_resource
+def _semantic_index(prompt_hash):
+    index = {"lock": threading.Lock()}
+    _reset_semantic_index(index)
+    return index
+
+# 색인 내용 초기화 함수 (잠금은 유지)
+def _reset_semantic_index(index):
+    index.update({
+        "vocab": {},
+        "df": array("i"),
+        "postings_docs": [],
+        "postings_tf": [],
+        "doc_grams": [],
+        "doc_tf": [],
+        "norms": array("f"),
+        "norm_basis": 0,
+        "texts": {},
+        "doc_texts": [],
+        "answers": [],
+        "created": array("d")
+    })
+
+# 문자 n-gram 빈도 계산 함수
+def char_ngrams(text):
+    """문장부호를 제거한 뒤 2~3글자 단위 n-gram 빈도 계산"""
+    counts = {}
+    words = re.sub(r"[^\w\s]", " ", text).split()
+    padded = f" {' '.join(words)} "
+    for size in SEMANTIC_NGRAM_SIZES:
+        for i in range(len(padded) - size + 1):
+            gram = padded[i:i + size]
+            counts[gram] = counts.get(gram, 0) + 1
+    return counts
+
+# 유사 질문 답변 재사용 가능 여부 확인 함수
+def symptoms_agree(query, stored):
+    """두 질문의 부정 표현과 숫자가 모두 같을 때만 True (정규화된 텍스트 기준)"""
+    return (
+        len(SEMANTIC_NEGATION_PATTERN.findall(query)) == len(SEMANTIC_NEGATION_PATTERN.findall(stored))
+        and sorted(float(n) for n in SEMANTIC_NUMBER_PATTERN.findall(query)) == sorted(float(n) for n in SEMANTIC_NUMBER_PATTERN.findall(stored))
+    )
+
+def _idf(doc_count, df):
+    import numpy as np
+    return np.log((1 + doc_count) / (1 + df)) + 1
+
+def _recompute_norms(index):
+    """문서 수가 두 배가 될 때마다 현재 IDF로 모든 문서 벡터 길이를 다시 계산"""
+    import numpy as np
+    doc_count = len(index["answers"])
+    idf = _idf(doc_count, np.frombuffer(index["df"], dtype=np.int32))
+    doc_ids = np.concatenate([np.frombuffer(docs, dtype=np.int32) for docs in index["postings_docs"]])
+    weights = np.concatenate([
+        np.frombuffer(tf, dtype=np.float32) * idf[gram_id]
+        for gram_id, tf in enumerate(index["postings_tf"])
+    ])
+    squared = np.bincount(doc_ids, weights=weights.astype(np.float64) ** 2, minlength=doc_count)
+    del doc_ids
+    index["norms"] = array("f", np.sqrt(squared).astype(np.float32).tobytes())
+    index["norm_basis"] = doc_count
+
+# 색인에 문서 하나를 추가하는 함수 (잠금 안에서 호출)
+def _semantic_index_insert(index, text, answer, created):
+    import numpy as np
+    doc_id = len(index["answers"])
+    index["texts"][text] = doc_id
+    index["doc_texts"].append(text)
+    index["answers"].append(answer)
+    index["created"].append(created)
+    gram_ids, tfs = [], []
+    for gram, count in char_ngrams(text).items():
+        gram_id = index["vocab"].get(gram)
+        if gram_id is None:
+            gram_id = index["vocab"][gram] = len(index["postings_docs"])
+            index["postings_docs"].append(array("i"))
+            index["postings_tf"].append(array("f"))
+            index["df"].append(0)
+        tf = 1 + math.log(count)
+        index["postings_docs"][gram_id].append(doc_id)
+        index["postings_tf"][gram_id].append(tf)
+        index["df"][gram_id] += 1
+        gram_ids.append(gram_id)
+        tfs.append(tf)
+    index["doc_grams"].append(np.array(gram_ids, dtype=np.int32))
+    index["doc_tf"].append(np.array(tfs, dtype=np.float32))
+    idf = _idf(doc_id + 1, np.array([index["df"][gram_id] for gram_id in gram_ids]))
+    index["norms"].append(float(np.linalg.norm(index["doc_tf"][-1] * idf)))
+    if doc_id + 1 >= 2 * index["norm_basis"]:
+        _recompute_norms(index)
+
+# 색인 정리 함수 (잠금 안에서 호출)
+def _prune_semantic_index(index, now):
+    """만료된 문서를 버리고, 남은 문서가 많으면 오래된 것부터 버려 한도의 3/4만 남긴 뒤 역색인을 다시 만듦
+    (한도에 닿을 때마다 다시 만들지 않도록 여유를 둠)"""
+    keep = RESPONSE_CACHE_SIZE * 3 // 4
+    docs = sorted(
+        (created, text, answer)
+        for text, answer, created in zip(index["doc_texts"], index["answers"], index["created"])
+        if now - created <= RESPONSE_CACHE_TTL
+    )[-keep:] if keep else []
+    _reset_semantic_index(index)
+    for created, text, answer in docs:
+        _semantic_index_insert(index, text, answer, created)
+    if docs:
+        _recompute_norms(index)
+
+# 유사 질문 색인 추가 함수
+def semantic_index_add(symptoms, answer):
+    """새 답변을 색인에 점진적으로 추가 (같은 질문이면 답변과 저장 시각만 갱신, 응답 캐시와 같은 한도·유효기간 적용)"""
+    index = _semantic_index(hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest())
+    text = normalize_symptoms(symptoms)
+    now = time.time()
+    with index["lock"]:
+        if text in index["texts"]:
+            doc_id = index["texts"][text]
+            index["answers"][doc_id] = answer
+            index["created"][doc_id] = now
+            return
+        if len(index["answers"]) >= RESPONSE_CACHE_SIZE:
+            _prune_semantic_index(index, now)
+        if RESPONSE_CACHE_SIZE:
+            _semantic_index_insert(index, text, answer, now)
+
+# 유사 질문 검색 함수
+def semantic_index_lookup(symptoms, candidates=5):
+    """가장 비슷한 과거 질문의 (답변, 코사인 유사도) 반환
+
+    역색인으로 후보를 고른 뒤, 상위 후보만 현재 IDF 기준의 정확한 코사인 유사도로 다시 계산
+    부정 표현이나 숫자가 다른 후보, RESPONSE_CACHE_TTL이 지난 후보는 유사도와 관계없이 제외
+    """
+    import numpy as np
+    index = _semantic_index(hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest())
+    with index["lock"]:
+        doc_count = len(index["answers"])
+        if not doc_count:
+            return None, 0.0
+        df = np.frombuffer(index["df"], dtype=np.int32)
+        query_weights, query_squared = {}, 0.0
+        doc_ids, weights = [], []
+        text = normalize_symptoms(symptoms)
+        for gram, count in char_ngrams(text).items():
+            gram_id = index["vocab"].get(gram)
+            # 색인에 없는 n-gram도 질문 벡터 길이에는 반영
+            idf = float(_idf(doc_count, df[gram_id] if gram_id is not None else 0))
+            weight = (1 + math.log(count)) * idf
+            query_squared += weight ** 2
+            if gram_id is None:
+                continue
+            query_weights[gram_id] = weight
+            doc_ids.append(np.frombuffer(index["postings_docs"][gram_id], dtype=np.int32))
+            weights.append(np.frombuffer(index["postings_tf"][gram_id], dtype=np.float32) * (weight * idf))
+        if not doc_ids:
+            return None, 0.0
+        scores = np.bincount(np.concatenate(doc_ids), weights=np.concatenate(weights), minlength=doc_count)
+        del doc_ids
+        scores /= np.maximum(np.frombuffer(index["norms"], dtype=np.float32), 1e-9)
+        scores[time.time() - np.frombuffer(index["created"], dtype=np.float64) > RESPONSE_CACHE_TTL] = 0
+
+        top = np.argpartition(-scores, candidates - 1)[:candidates] if doc_count > candidates else range(doc_count)
+        best, best_similarity = None, 0.0
+        for doc_id in top:
+            if not scores[doc_id] or not symptoms_agree(text, index["doc_texts"][doc_id]):
+                continue
+            grams = index["doc_grams"][doc_id]
+            doc_weights = index["doc_tf"][doc_id] * _idf(doc_count, df[grams])
+            dot = sum(float(w) * query_weights.get(int(g), 0.0) for g, w in zip(grams, doc_weights))
+            similarity = dot / max(float(np.linalg.norm(doc_weights)) * math.sqrt(query_squared), 1e-9)
+            if similarity > best_similarity:
+                best, best_similarity = int(doc_id), similarity
+        if best is None:
+            return None, 0.0
+        return index["answers"][best], best_similarity
+
+# 대화 맥락 설정 (요청마다 프롬프트 토큰이 예산을 넘지 않도록 유지)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "8000"))
+CONTEXT_RECENT_TURNS = int(os.getenv("CONTEXT_RECENT_TURNS", "3"))
+# 요약하지 않은 턴이 이 수를 넘을 때만 최근 N개 턴을 남기고 한꺼번에 요약
+# (그 사이에는 요청 앞부분이 그대로 유지되어 OpenAI 프롬프트 캐시가 적중)
+CONTEXT_MAX_TURNS = max(int(os.getenv("CONTEXT_MAX_TURNS", str(2 * CONTEXT_RECENT_TURNS))), CONTEXT_RECENT_TURNS)
+CONTEXT_SUMMARY_MODEL = os.getenv("CONTEXT_SUMMARY_MODEL", "gpt-4o-mini")
+CONTEXT_SUMMARY_MAX_TOKENS = 300
+MESSAGE_TOKEN_OVERHEAD = 4
+
+# 이전 상담 요약용 시스템 프롬프트
+SUMMARY_PROMPT = """
+당신은 어린이 건강 상담 기록을 요약하는 도우미입니다.
+기존 요약과 새 대화를 합쳐, 이후 상담에 필요한 정보만 한국어로 간결하게 정리하세요.
+- 아이의 나이, 증상, 경과(시작 시점, 열 등 수치), 복용 약, 알레르기
+- 이전에 안내한 응급 여부 판단과 주요 조언
+- 보호자가 추가로 궁금해한 점
+요약은 10줄 이내로 작성하고, 새로운 의학적 판단은 추가하지 마세요.
+"""
+
+# tiktoken 인코더 (설치되어 있으면 처음 토큰을 셀 때 한 번만 불러옴)
+@st.cache_resource
+def _token_encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+# 로컬 토큰 수 계산 함수
+def count_tokens(text):
+    """tiktoken이 있으면 정확히 세고, 없으면 영문 4자·한글 1자당 1토큰으로 추정"""
+    encoding = _token_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    ascii_chars = sum(ch.isascii() for ch in text)
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+# 메시지 목록의 프롬프트 토큰 수 계산 함수
+def count_message_tokens(messages, image_tokens=0):
+    total = image_tokens
+    for message in messages:
+        total += MESSAGE_TOKEN_OVERHEAD
+        if isinstance(message["content"], str):
+            total += count_tokens(message["content"])
+        else:
+            total += sum(count_tokens(part["text"]) for part in message["content"] if part["type"] == "text")
+    return total
+
+# 대화 기록을 (부모님 질문, 챗봇 답변) 메시지 쌍 목록으로 변환하는 함수
+def split_turns(history):
+    return [(previous, message) for previous, message in zip(history, history[1:]) if previous["role"] == "user" and message["role"] == "bot"]
+
+# 아직 요약에 합쳐지지 않은 턴 목록
+def unsummarized_turns(history, summary):
+    return [(user, bot) for user, bot in split_turns(history) if bot["seq"] >= summary["upto"]]
+
+# 요청에 함께 보낼 대화 맥락 생성 함수
+def build_context_messages(history, symptoms=""):
+    """이전 상담 요약과 아직 요약하지 않은 턴을 그대로 담은 메시지 목록 생성
+    
+    요약이 바뀌기 전까지는 턴이 뒤에 덧붙기만 하므로 직전 요청이 다음 요청의 앞부분과 바이트 단위로 같음
+    """
+    summary = st.session_state.get("context_summary", {"text": "", "upto": 0})
+    turns = unsummarized_turns(history, summary)[-CONTEXT_MAX_TURNS:] if CONTEXT_MAX_TURNS else []
+    # 같은 질문을 다시 보낸 경우 직전 답변을 맥락에 넣지 않음
+    if turns and symptoms.strip() and normalize_symptoms(turns[-1][0]["content"]) == normalize_symptoms(symptoms):
+        turns = turns[:-1]
+    context = []
+    if summary["text"]:
+        context.append({"role": "system", "content": f"이전 상담 요약:\n{summary['text']}"})
+    for user, bot in turns:
+        context.append({"role": "user", "content": user["content"]})
+        context.append({"role": "assistant", "content": bot["content"]})
+    return context
+
+# 토큰 예산에 맞게 대화 맥락을 줄이는 함수
+def fit_context_to_budget(context, fixed_tokens):
+    """예산을 넘으면 가장 오래된 턴부터 빼고, 턴이 남지 않으면 요약도 제외"""
+    context = list(context)
+    while context and fixed_tokens + count_message_tokens(context) > CONTEXT_TOKEN_BUDGET:
+        turn_start = 1 if context[0]["role"] == "system" else 0
+        if len(context) > turn_start:
+            del context[turn_start:turn_start + 2]
+        else:
+            del context[0]
+    return context
+
+# 작업자 스레드에서 실행되는 요약 호출 함수 (Streamlit 호출 없음)
+def _summary_worker(client, messages, scheduler, metrics):
+    """(요약 문장, 사용량) 반환, 실패하면 예외를 그대로 올려 메인 스레드에서 처리"""
+    reserved = count_message_tokens(messages) + CONTEXT_SUMMARY_MAX_TOKENS
+    started = time.perf_counter()
+    # 요약은 상담 요청보다 뒤로 미룸
+    response = call_with_retries(
+        scheduler,
+        lambda: client.chat.completions.create(
+            model=CONTEXT_SUMMARY_MODEL,
+            messages=messages,
+            max_tokens=CONTEXT_SUMMARY_MAX_TOKENS,
+            temperature=0
+        ),
+        reserved,
+        PRIORITY_BACKGROUND,
+        metrics=metrics
+    )
+    refund_unused_tokens(scheduler, reserved, response.usage)
+    record_completion(metrics, CONTEXT_SUMMARY_MODEL, time.perf_counter() - started, usage=response.usage, route="summary")
+    return response.choices[0].message.content.strip(), response.usage
+
+# 끝난 백그라운드 요약 반영 함수
+def apply_context_summary(wait=False):
+    """요약이 끝났으면 세션에 반영하고 True 반환 (대화를 초기화했으면 결과를 버림)"""
+    pending = st.session_state.get("pending_summary")
+    if pending is None or not (wait or pending["future"].done()):
+        return False
+    st.session_state.pending_summary = None
+    try:
+        text, usage = pending["future"].result()
+    except Exception:
+        # 기존 요약을 유지하고 다음 턴에 다시 시도
+        logger.warning("대화 요약에 실패했습니다. 다음 턴에 다시 시도합니다.", exc_info=True)
+        return False
+    charge_session_quota(usage, count_requests=False)
+    if st.session_state.get("session_id") != pending["session_id"]:
+        return False
+    st.session_state.context_summary = {"text": text, "upto": pending["upto"]}
+    return True
+
+# 이전 상담 요약 갱신 함수
+def update_context_summary(history, wait=False):
+    """요약하지 않은 턴이 CONTEXT_MAX_TURNS를 넘으면 최근 N개 턴만 남기고 나머지를 기존 요약에 합침
+
+    요약은 요청 작업자 풀에서 실행하므로 답변 표시를 막지 않고, 다음 재실행이나 다음 요청 전에 반영됨
+    (wait=True이면 끝날 때까지 기다려 바로 반영)
+    """
+    if "context_summary" not in st.session_state:
+        st.session_state.context_summary = {"text": "", "upto": 0}
+    apply_context_summary()
+    if st.session_state.get("pending_summary") is not None:
+        if wait:
+            apply_context_summary(wait=True)
+        return
+    summary = st.session_state.context_summary
+    # 세션에는 최근 메시지만 남으므로 턴 위치 대신 메시지 순번으로 어디까지 요약했는지 기록
+    turns = unsummarized_turns(history, summary)
+    # 턴마다 요약하면 요청 앞부분이 매번 바뀌어 프롬프트 캐시가 적중하지 않으므로 몰아서 요약
+    if len(turns) <= CONTEXT_MAX_TURNS:
+        return
+    folded = turns[:len(turns) - CONTEXT_RECENT_TURNS]
+    transcript = "\n\n".join(f"부모님: {user['content']}\n챗봇: {bot['content']}" for user, bot in folded)
+    messages = [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": f"기존 요약:\n{summary['text'] or '(없음)'}\n\n새 대화:\n{transcript}"}
+    ]
+    client = get_openai_client(st.session_state.api_key)
+    st.session_state.pending_summary = {
+        "future": _request_executor().submit(_summary_worker, client, messages, session_scheduler(), _metrics_store()),
+        "upto": folded[-1][1]["seq"] + 1,
+        "session_id": st.session_state.get("session_id")
+    }
+    if wait:
+        apply_context_summary(wait=True)
+
+# 요청 종류별 모델 설정
+ADVICE_MODEL_SETTINGS = {"model": "gpt-4o", "max_tokens": 1200, "temperature": 0.7}
+IMAGE_MODEL_SETTINGS = {"model": "gpt-4o", "max_tokens": 1500, "temperature": 0.3}
+
+# 고를 수 있는 모델 (사이드바·MODEL_OVERRIDE로 고정 가능)
+ROUTABLE_MODELS = ("gpt-4o", "gpt-4o-mini")
+MODEL_OVERRIDE = os.getenv("MODEL_OVERRIDE", "")
+
+# 모델·답변 길이 선택 규칙 (위에서부터 처음 맞는 규칙 사용, ROUTING_RULES_FILE에 같은 형식의 JSON 목록을 두면 대체)
+# 조건: kind(advice/image), emergency, has_images, follow_up, max_chars(증상 글자 수 이하), min_images
+# 답변 구조(SYSTEM_PROMPT의 6개 항목)가 잘리지 않도록 가벼운 규칙도 출력 토큰을 넉넉히 남김
+DEFAULT_ROUTING_RULES = [
+    {"name": "emergency", "label": "응급 신호", "when": {"kind": "advice", "emergency": True}},
+    {"name": "image_question", "label": "사진 첨부", "when": {"kind": "advice", "has_images": True}},
+    {"name": "short_follow_up", "label": "짧은 추가 질문", "when": {"kind": "advice", "follow_up": True, "max_chars": 60},
+     "model": "gpt-4o-mini", "max_tokens": 700},
+    {"name": "short_question", "label": "짧은 질문", "when": {"kind": "advice", "max_chars": 40},
+     "model": "gpt-4o-mini", "max_tokens": 1000},
+    {"name": "multi_image", "label": "여러 장 사진", "when": {"kind": "image", "min_images": 2}, "max_tokens": 1800}
+]
+ROUTING_RULES_FILE = os.getenv("ROUTING_RULES_FILE", "")
+
+# 모델 선택 규칙 읽기 함수 (파일은 프로세스당 한 번만 읽음)
+@st.cache_resource
+def routing_rules():
+    if not ROUTING_RULES_FILE:
+        return DEFAULT_ROUTING_RULES
+    with open(ROUTING_RULES_FILE, encoding="utf-8") as f:
+        return json.load(f)
+
+# 규칙 조건 확인 함수
+def rule_matches(when, features):
+    for key, expected in when.items():
+        if key == "max_chars":
+            if features["chars"] > expected:
+                return False
+        elif key == "min_images":
+            if features["images"] < expected:
+                return False
+        elif features.get(key) != expected:
+            return False
+    return True
+
+# 모델·답변 길이 선택 함수
+def route_request(kind, symptoms="", image_count=0, follow_up=False, override=None):
+    """요청 특징으로 규칙을 골라 (규칙 정보, 모델 설정) 반환, override가 있으면 모델만 고정"""
+    features = {
+        "kind": kind,
+        "emergency": kind == "advice" and is_emergency(symptoms),
+        "has_images": image_count > 0,
+        "images": image_count,
+        "follow_up": follow_up,
+        "chars": len(symptoms.strip())
+    }
+    settings = dict(ADVICE_MODEL_SETTINGS if kind == "advice" else IMAGE_MODEL_SETTINGS)
+    route = {"name": "default", "label": "기본"}
+    for rule in routing_rules():
+        if rule_matches(rule.get("when", {}), features):
+            settings.update({key: rule[key] for key in ("model", "max_tokens", "temperature") if key in rule})
+            route = {"name": rule["name"], "label": rule.get("label", rule["name"])}
+            break
+    override = override or MODEL_OVERRIDE
+    if override:
+        settings["model"] = override
+        route = {"name": f"{route['name']}:override", "label": f"{route['label']}, 모델 고정"}
+    return {**route, "model": settings["model"], "max_tokens": settings["max_tokens"]}, settings
+
+# 화면에서 고른 모델 (자동이면 None)
+def session_model_override():
+    choice = st.session_state.get("model_override", "자동")
+    return None if choice == "자동" else choice
+
+
+# 이미지 정밀 분석 요청 문구
+IMAGE_ANALYSIS_REQUEST = "이 이미지를 보고 어린이의 건강 상태를 분석해주세요. 관찰되는 증상, 가능한 원인, 응급도, 초기 대처방법을 포함하여 종합적으로 설명해주세요."
+
+# 여러 장 첨부 안내 문구
+MULTI_IMAGE_NOTE = "첨부된 사진 {count}장은 같은 아이를 여러 각도나 시점(전후 비교 등)에서 찍은 것입니다. 사진 간 차이도 함께 살펴봐주세요."
+
+# 이미지 메시지 항목 생성 함수
+def image_content_parts(encoded_images):
+    return [
+        {"type": "image_url", "image_url": {"url": image["url"], "detail": image["detail"]}}
+        for image in encoded_images
+    ]
+
+# 이미지 분석 메시지 구성 함수 (사진 여러 장도 요청 하나로 보냄)
+def build_image_messages(encoded_images):
+    """고정 문구를 앞에, 사진과 사진 수에 따라 바뀌는 안내를 뒤에 두어 요청 앞부분을 항상 같게 유지"""
+    content_list = [{"type": "text", "text": IMAGE_ANALYSIS_REQUEST}, *image_content_parts(encoded_images)]
+    if len(encoded_images) > 1:
+        content_list.append({"type": "text", "text": MULTI_IMAGE_NOTE.format(count=len(encoded_images))})
+    return [
+        {"role": "system", "content": IMAGE_SYSTEM_PROMPT},
+        {"role": "user", "content": content_list}
+    ]
+
+# 종합 상담 메시지 구성 함수
+def build_advice_messages(symptoms, encoded_images=(), context=()):
+    """시스템 프롬프트, 토큰 예산에 맞춘 대화 맥락, 이번 질문(사진 포함) 순으로 구성
+    
+    앞에서부터 바뀌지 않는 순서로 쌓아 프롬프트 캐시가 시스템 프롬프트와 이전 대화까지 재사용되도록 함
+    """
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    
+    content_list = []
+    image_tokens = 0
+    if symptoms.strip():
+        content_list.append({"type": "text", "text": f"증상: {symptoms}"})
+
+    if encoded_images:
+        image_tokens = total_image_tokens(encoded_images)
+        content_list.extend(image_content_parts(encoded_images))
+        # 사진 관련 안내는 사진 뒤에 별도 항목으로 붙임 (증상 문구는 기록에 남는 질문과 같게 유지)
+        note = "첨부된 이미지도 함께 분석해주세요." if symptoms.strip() else "첨부된 이미지를 분석해주세요."
+        if len(encoded_images) > 1:
+            note += "\n" + MULTI_IMAGE_NOTE.format(count=len(encoded_images))
+        content_list.append({"type": "text", "text": note})
+
+    user_messages = [{"role": "user", "content": content_list}] if content_list else []
+    context = fit_context_to_budget(context, count_message_tokens(messages + user_messages, image_tokens))
+    return messages + context + user_messages
+
+# 응답 캐시 키 함수 (요청 종류별)
+def advice_cache_key(symptoms, image_hash, context, settings=ADVICE_MODEL_SETTINGS):
+    return make_cache_key(SYSTEM_PROMPT, symptoms, image_hash, context=context, **settings)
+
+def image_cache_key(image_hash, settings=IMAGE_MODEL_SETTINGS):
+    return make_cache_key(IMAGE_SYSTEM_PROMPT, "", image_hash, **settings)
+
+# 요청별 기록 초기화 함수
+def reset_request_stats():
+    st.session_state.last_ttft = None
+    st.session_state.last_cache_hit = False
+    st.session_state.last_similarity = None
+    st.session_state.last_prompt_tokens = None
+    st.session_state.last_image_stats = None
+    st.session_state.last_route = None
+    st.session_state.last_latency = None
+    st.session_state.last_cached_ratio = None
+    st.session_state.last_truncated = False
+
 # 향상된 이미지 분석 함수
-def analyze_medical_image(uploaded_file):
-    """GPT-4 Vision을 사용하여 의료 이미지 분석"""
+def analyze_medical_image(uploaded_files, use_cache=True):
+    """GPT-4 Vision을 사용하여 의료 이미지 분석 (여러 장이면 한 요청으로 함께 분석)"""
+    reset_request_stats()
     try:
-        client = OpenAI(api_key=st.session_state.api_key)
+        route, settings = route_request("image", image_count=len(uploaded_files), override=session_model_override())
+        st.session_state.last_route = route
+        cache_key = image_cache_key(images_content_hash(uploaded_files), settings)
+        if use_cache:
+            cached = cache_get(cache_key)
+            if cached is not None:
+                st.session_state.last_cache_hit = True
+                _metrics_store().increment("chatbot_cache_hits_total", type="exact")
+                return cached
+
+        client = get_openai_client(st.session_state.api_key)
         
-        base64_image = encode_image_to_base64(uploaded_file)
-        if not base64_image:
+        encoded_images = encode_uploaded_images(uploaded_files)
+        if not encoded_images:
             return "이미지 처리 중 오류가 발생했습니다."
         
-        progress_placeholder = st.empty()
-        for i in range(0, 101, 20):
-            time.sleep(0.2)
-            show_loading_bar(i, progress_placeholder)
-        
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": IMAGE_SYSTEM_PROMPT},
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "이 이미지를 보고 어린이의 건강 상태를 분석해주세요. 관찰되는 증상, 가능한 원인, 응급도, 초기 대처방법을 포함하여 종합적으로 설명해주세요."},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}", "detail": "high"}}
-                    ]
-                }
-            ],
-            max_tokens=1500,
-            temperature=0.3
+        messages = build_image_messages(encoded_images)
+        st.session_state.last_prompt_tokens = count_message_tokens(messages, total_image_tokens(encoded_images))
+        content = request_chat_completion(
+            client, messages=messages, prompt_tokens=st.session_state.last_prompt_tokens, route=route["name"], **settings
         )
+        # 길이 한도에서 끊긴 답변은 저장하지 않음 (다음에 같은 질문이면 다시 생성)
+        if content and not st.session_state.last_truncated:
+            cache_put(cache_key, content)
+        return content
         
-        progress_placeholder.empty()
-        return response.choices[0].message.content
-        
+    except SchedulerBusy:
+        return BUSY_MESSAGE
     except Exception as e:
-        if 'progress_placeholder' in locals():
-            progress_placeholder.empty()
         return f"이미지 분석 중 오류가 발생했습니다: {str(e)}\n\n⚠️ API 키가 올바른지, 그리고 GPT-4 Vision 모델 사용 권한이 있는지 확인해주세요."
 
 # 텍스트+이미지 상담 함수
-def get_medical_advice(symptoms="", uploaded_file=None):
-    """OpenAI API를 호출하여 의료 조언을 얻는 함수"""
+def get_medical_advice(symptoms="", uploaded_files=(), use_cache=True, history=None):
+    """OpenAI API를 호출하여 의료 조언을 얻는 함수 (이전 대화는 토큰 예산 안에서 함께 전달)"""
+    reset_request_stats()
     try:
-        client = OpenAI(api_key=st.session_state.api_key)
-        
-        progress_placeholder = st.empty()
-        for i in range(0, 101, 10):
-            time.sleep(0.1)
-            show_loading_bar(i, progress_placeholder)
-        
-        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-        
-        content_list = []
-        if symptoms.strip():
-            content_list.append({"type": "text", "text": f"증상: {symptoms}"})
-
-        if uploaded_file:
-            base64_image = encode_image_to_base64(uploaded_file)
-            if base64_image:
-                if symptoms.strip():
-                    content_list[0]["text"] += "\n\n첨부된 이미지도 함께 분석해주세요."
-                else: # 텍스트 없이 이미지만 있는 경우
-                    content_list.append({"type": "text", "text": "첨부된 이미지를 분석해주세요."})
-
-                content_list.append({
-                    "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{base64_image}", "detail": "high"}
-                })
+        image_hash = images_content_hash(uploaded_files) if uploaded_files else None
+        context = build_context_messages(history or [], symptoms)
+        route, settings = route_request(
+            "advice", symptoms, len(uploaded_files), follow_up=bool(context), override=session_model_override()
+        )
+        st.session_state.last_route = route
+        cache_key = advice_cache_key(symptoms, image_hash, context, settings)
+        emergency = is_emergency(symptoms)
+        if use_cache:
+            cached = cache_get(cache_key)
+            if cached is not None:
+                st.session_state.last_cache_hit = True
+                _metrics_store().increment("chatbot_cache_hits_total", type="exact")
+                return cached
+            # 이전 대화가 없고, 이미지가 없고, 응급 신호가 아닌 질문만 비슷한 과거 답변을 재사용
+            if not context and not uploaded_files and not emergency:
+                similar, similarity = semantic_index_lookup(symptoms)
+                if similar is not None and similarity >= SEMANTIC_CACHE_THRESHOLD:
+                    st.session_state.last_cache_hit = True
+                    st.session_state.last_similarity = similarity
+                    _metrics_store().increment("chatbot_cache_hits_total", type="semantic")
+                    return similar
+
+        client = get_openai_client(st.session_state.api_key)
         
-        if content_list:
-             messages.append({"role": "user", "content": content_list})
+        # 사진 인코딩에 실패하면 (오류는 이미 표시됨) 증상 텍스트만으로 상담
+        encoded_images = (encode_uploaded_images(uploaded_files) if uploaded_files else None) or []
+        messages = build_advice_messages(symptoms, encoded_images, context)
+        st.session_state.last_prompt_tokens = count_message_tokens(messages, total_image_tokens(encoded_images))
 
-        response = client.chat.completions.create(
-            model="gpt-4o",
+        # 응급 신호가 있는 질문은 대기열에서 먼저 처리
+        content = request_chat_completion(
+            client,
             messages=messages,
-            max_tokens=1200,
-            temperature=0.7
+            priority=PRIORITY_EMERGENCY if emergency else PRIORITY_NORMAL,
+            prompt_tokens=st.session_state.last_prompt_tokens,
+            route=route["name"],
+            **settings
         )
+        # 길이 한도에서 끊긴 답변은 정확한 질문·비슷한 질문 캐시 모두에 저장하지 않음
+        if content and not st.session_state.last_truncated:
+            cache_put(cache_key, content)
+            if not context and not uploaded_files and not emergency:
+                semantic_index_add(symptoms, content)
+        return content
         
-        progress_placeholder.empty()
-        return response.choices[0].message.content
-        
+    except SchedulerBusy:
+        return BUSY_MESSAGE
+    except Exception as e:
+        return f"죄송합니다. 오류가 발생했습니다: {str(e)}\n\n⚠️ API 키가 올바른지 확인해주세요."
+
+# 동시 요청 작업자 수
+REQUEST_WORKERS = int(os.getenv("REQUEST_WORKERS", "8"))
+
+# 프로세스 전체에서 공유하는 요청 작업자 풀
+@st.cache_resource
+def _request_executor():
+    return ThreadPoolExecutor(max_workers=REQUEST_WORKERS, thread_name_prefix="consult")
+
+# 작업자 스레드에서 실행되는 API 호출 함수 (Streamlit 호출 없음)
+def _completion_worker(client, name, request, streaming, events, cancel, scheduler, priority, reserved, metrics, route="default"):
+    """스케줄러 차례를 기다리며 대기 순서를, 이후 받은 토큰을 이벤트 큐로 보내고, 취소되면 스트림을 닫고 멈춤"""
+    started = first_token = finish_reason = None
+
+    def create():
+        nonlocal started
+        # 차례를 받는 사이 취소되었으면 호출하지 않고 예약한 요청·토큰을 돌려줌
+        if cancel.is_set():
+            scheduler.requests.refund(1)
+            scheduler.tokens.refund(reserved)
+            raise RequestCancelled()
+        started = time.perf_counter()
+        events.put((name, "admitted", started))
+        if not streaming:
+            return client.chat.completions.create(**request)
+        return client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **request)
+
+    def report_wait(position, eta):
+        if cancel.is_set():
+            raise RequestCancelled()
+        events.put((name, "wait", (position, eta)))
+
+    try:
+        # 작업자 풀에서 차례를 기다리는 동안 취소되었으면 스케줄러 대기열에도 들어가지 않음
+        if cancel.is_set():
+            raise RequestCancelled()
+        result = call_with_retries(scheduler, create, reserved, priority, report_wait, metrics=metrics)
+        if not streaming:
+            usage = result.usage
+            refund_unused_tokens(scheduler, reserved, usage)
+            finish_reason = result.choices[0].finish_reason
+            events.put((name, "delta", result.choices[0].message.content or ""))
+        else:
+            usage = None
+            try:
+                for chunk in result:
+                    if cancel.is_set():
+                        break
+                    if getattr(chunk, "usage", None) is not None:
+                        usage = chunk.usage
+                        refund_unused_tokens(scheduler, reserved, usage)
+                    if chunk.choices and chunk.choices[0].finish_reason:
+                        finish_reason = chunk.choices[0].finish_reason
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if first_token is None:
+                            first_token = time.perf_counter() - started
+                        events.put((name, "delta", chunk.choices[0].delta.content))
+            finally:
+                result.close()
+        outcome = "truncated" if finish_reason == "length" else "ok"
+        record_completion(metrics, request["model"], time.perf_counter() - started, first_token, usage, outcome, route)
+        events.put((name, "done", (usage, finish_reason)))
+    except Exception as e:
+        if not isinstance(e, RequestCancelled):
+            metrics.increment("chatbot_requests_total", model=request["model"], route=route, outcome="error")
+        events.put((name, "error", e))
+
+# 진행 중 요청이 취소되었음을 알리는 예외
+class RequestCancelled(Exception):
+    pass
+
+# 여러 요청 동시 실행 함수
+def run_concurrent_completions(client, requests, titles, reserved, priority=PRIORITY_NORMAL, routes=None):
+    """요청을 동시에 보내고 받는 대로 각자 말풍선에 그림, 중간에 재실행·초기화되면 남은 요청 취소 ((답변, 오류, 끊긴 요청 이름) 반환)"""
+    events = queue.Queue()
+    cancel = threading.Event()
+    st.session_state.inflight_cancel = cancel
+    streaming = st.session_state.get("streaming", True)
+    scheduler = session_scheduler()
+    metrics = _metrics_store()
+    placeholders = {name: st.empty() for name in requests}
+    parts = {name: [] for name in requests}
+    admitted = {}
+    errors = {}
+    usages = {}
+    truncated = set()
+    for name, request in requests.items():
+        _request_executor().submit(
+            _completion_worker, client, name, request, streaming, events, cancel, scheduler, priority, reserved[name], metrics,
+            (routes or {}).get(name, "default")
+        )
+    pending = set(requests)
+    last_render = 0.0
+    try:
+        while pending:
+            if cancel.is_set():
+                break
+            try:
+                name, kind, payload = events.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if kind == "wait":
+                placeholders[name].info(format_queue_wait(*payload))
+                continue
+            if kind == "admitted":
+                admitted[name] = payload
+                placeholders[name].empty()
+                continue
+            if kind == "delta":
+                if st.session_state.get("last_ttft") is None:
+                    st.session_state.last_ttft = time.perf_counter() - admitted[name]
+                parts[name].append(payload)
+            else:
+                pending.discard(name)
+                if kind == "error":
+                    errors[name] = payload
+                else:
+                    usages[name], finish_reason = payload
+                    if finish_reason == "length":
+                        truncated.add(name)
+            now = time.perf_counter()
+            if kind != "delta" or now - last_render >= STREAM_RENDER_INTERVAL:
+                for key, placeholder in placeholders.items():
+                    if parts[key]:
+                        placeholder.markdown(render_bot_bubble(f"{titles[key]}<br>{''.join(parts[key])}", cursor=key in pending), unsafe_allow_html=True)
+                last_render = now
+    finally:
+        cancel.set()
+        for placeholder in placeholders.values():
+            placeholder.empty()
+    if pending:
+        raise RequestCancelled()
+    st.session_state.last_cached_ratio = cached_prompt_ratio(*usages.values())
+    st.session_state.last_truncated = bool(truncated)
+    charge_session_quota(*usages.values())
+    contents = {name: "".join(parts[name]) for name in requests}
+    return {name: finish_truncated_answer(content) if name in truncated else content for name, content in contents.items()}, errors, truncated
+
+# 종합 상담 + 이미지 정밀 분석 동시 요청 함수
+def get_combined_advice(symptoms, uploaded_files, use_cache=True, history=None):
+    """두 요청을 동시에 보내 먼저 도착하는 답변부터 보여주고, 결과를 하나의 상담 기록으로 합침"""
+    reset_request_stats()
+    try:
+        image_hash = images_content_hash(uploaded_files)
+        context = build_context_messages(history or [], symptoms)
+        override = session_model_override()
+        routes, settings = {}, {}
+        routes["advice"], settings["advice"] = route_request(
+            "advice", symptoms, len(uploaded_files), follow_up=bool(context), override=override
+        )
+        routes["image"], settings["image"] = route_request("image", image_count=len(uploaded_files), override=override)
+        st.session_state.last_route = routes["advice"]
+        cache_keys = {
+            "advice": advice_cache_key(symptoms, image_hash, context, settings["advice"]),
+            "image": image_cache_key(image_hash, settings["image"])
+        }
+        results = {name: cache_get(key) if use_cache else None for name, key in cache_keys.items()}
+        missing = [name for name, content in results.items() if content is None]
+        st.session_state.last_cache_hit = not missing
+        if len(missing) < len(results):
+            _metrics_store().increment("chatbot_cache_hits_total", len(results) - len(missing), type="exact")
+
+        if missing:
+            encoded_images = encode_uploaded_images(uploaded_files)
+            if not encoded_images:
+                return "이미지 처리 중 오류가 발생했습니다."
+            messages = {
+                "advice": build_advice_messages(symptoms, encoded_images, context),
+                "image": build_image_messages(encoded_images)
+            }
+            prompt_tokens = {
+                name: count_message_tokens(messages[name], total_image_tokens(encoded_images)) for name in missing
+            }
+            st.session_state.last_prompt_tokens = sum(prompt_tokens.values())
+            titles = {"advice": "🩺 <strong>종합 상담</strong>", "image": "📸 <strong>이미지 정밀 분석</strong>"}
+            contents, errors, truncated = run_concurrent_completions(
+                get_openai_client(st.session_state.api_key),
+                {name: {"messages": messages[name], **settings[name]} for name in missing},
+                titles,
+                reserved={name: prompt_tokens[name] + settings[name]["max_tokens"] for name in missing},
+                priority=PRIORITY_EMERGENCY if is_emergency(symptoms) else PRIORITY_NORMAL,
+                routes={name: routes[name]["name"] for name in missing}
+            )
+            for name in missing:
+                if isinstance(errors.get(name), SchedulerBusy):
+                    results[name] = BUSY_MESSAGE
+                elif name in errors:
+                    results[name] = f"오류가 발생했습니다: {str(errors[name])}"
+                else:
+                    results[name] = contents[name]
+                    if contents[name] and name not in truncated:
+                        cache_put(cache_keys[name], contents[name])
+
+        return f"{results['advice']}\n\n---\n\n📸 **이미지 정밀 분석**\n\n{results['image']}"
+
+    except RequestCancelled:
+        return "요청이 취소되었습니다."
+    except SchedulerBusy:
+        return BUSY_MESSAGE
     except Exception as e:
-        if 'progress_placeholder' in locals():
-            progress_placeholder.empty()
         return f"죄송합니다. 오류가 발생했습니다: {str(e)}\n\n⚠️ API 키가 올바른지 확인해주세요."
 
+# 상담 기록 저장소 설정 (CONSULT_DB를 비우면 디스크에 저장하지 않음)
+CONSULT_DB = os.getenv("CONSULT_DB", "consultations.db")
+CONSULT_FLUSH_INTERVAL = float(os.getenv("CONSULT_FLUSH_INTERVAL", "0.5"))
+CONSULT_BATCH_SIZE = int(os.getenv("CONSULT_BATCH_SIZE", "500"))
+CONSULT_QUEUE_SIZE = int(os.getenv("CONSULT_QUEUE_SIZE", "10000"))
+
+# 화면 세션에 보관하는 최근 메시지 수 (더 오래된 메시지는 저장소에서 필요할 때 읽음)
+# 요약되기 전의 턴이 잘려 나가지 않도록 최근 턴 수보다 넉넉히 유지
+HISTORY_MEMORY_LIMIT = max(int(os.getenv("HISTORY_MEMORY_LIMIT", "200")), 2 * CONTEXT_MAX_TURNS + 4)
+
+CONSULT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    message_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    meta TEXT,
+    created REAL NOT NULL,
+    PRIMARY KEY (session_id, seq)
+);
+CREATE TABLE IF NOT EXISTS feedback (
+    session_id TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    feedback TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS feedback_message ON feedback (session_id, message_id);
+"""
+
+CONSULT_INSERTS = {
+    "messages": "INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+    "feedback": "INSERT INTO feedback VALUES (?, ?, ?, ?)"
+}
+
+# 상담 기록 저장소 (추가만 하는 SQLite WAL, 쓰기는 백그라운드 스레드가 모아서 한 번에 커밋)
+class ConsultationStore:
+    def __init__(self, path):
+        self.path = path
+        self.events = queue.Queue(maxsize=CONSULT_QUEUE_SIZE)
+        self.written = 0
+        self.dropped = 0
+        with closing(self._connect()) as connection:
+            connection.executescript(CONSULT_SCHEMA)
+        threading.Thread(target=self._run, name="consult-writer", daemon=True).start()
+        # 종료 직전 큐에 남은 기록까지 저장
+        atexit.register(self.flush)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def submit(self, table, row):
+        """화면 재실행을 막지 않도록 큐에 넣기만 함 (큐가 가득 차면 버리고 개수만 기록)"""
+        try:
+            self.events.put_nowait((table, row))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        connection = self._connect()
+        while True:
+            batch = [self.events.get()]
+            # 첫 기록 이후 잠시 더 모아 한 트랜잭션으로 커밋 (그룹 커밋)
+            deadline = time.monotonic() + CONSULT_FLUSH_INTERVAL
+            while len(batch) < CONSULT_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.events.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                with connection:
+                    for table, sql in CONSULT_INSERTS.items():
+                        rows = [row for kind, row in batch if kind == table]
+                        if rows:
+                            connection.executemany(sql, rows)
+                self.written += len(batch)
+            except sqlite3.Error:
+                self.dropped += len(batch)
+            finally:
+                for _ in batch:
+                    self.events.task_done()
+
+    def flush(self, timeout=5.0):
+        """큐에 쌓인 기록이 모두 저장될 때까지 최대 timeout초 기다림"""
+        deadline = time.monotonic() + timeout
+        while self.events.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return not self.events.unfinished_tasks
+
+    def load_messages(self, session_id, before_seq, limit):
+        """before_seq보다 앞선 메시지를 오래된 순서로 최대 limit개 반환"""
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                "SELECT seq, message_id, role, content, meta FROM messages "
+                "WHERE session_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                (session_id, before_seq, limit)
+            ).fetchall()
+        return [
+            {"role": role, "content": content, "id": message_id, "seq": seq, **json.loads(meta or "{}")}
+            for seq, message_id, role, content, meta in reversed(rows)
+        ]
+
+# 프로세스 전체에서 공유하는 상담 기록 저장소
+@st.cache_resource
+def _consultation_store():
+    return ConsultationStore(CONSULT_DB) if CONSULT_DB else None
+
 # 피드백 저장 함수
 def save_feedback(message_id, feedback):
     if 'feedback' not in st.session_state:
         st.session_state.feedback = {}
     st.session_state.feedback[message_id] = feedback
+    store = _consultation_store()
+    if store:
+        store.submit("feedback", (st.session_state.session_id, message_id, feedback, time.time()))
     st.toast(f"피드백('{feedback}')을 남겨주셔서 감사합니다!", icon="😊")
 
+# 메시지 기록 함수
+def append_message(message):
+    """순번과 id를 붙여 세션에 추가하고 저장소에 넘긴 뒤, 세션에는 최근 HISTORY_MEMORY_LIMIT개만 남김"""
+    seq = st.session_state.get("message_seq", 0)
+    st.session_state.message_seq = seq + 1
+    message["seq"] = seq
+    message["id"] = f"{message['role']}_{seq}"
+    messages = st.session_state.messages
+    messages.append(message)
+
+    store = _consultation_store()
+    if store:
+        meta = {key: value for key, value in message.items() if key not in ("role", "content", "id", "seq")}
+        store.submit("messages", (
+            st.session_state.session_id, seq, message["id"], message["role"], message["content"],
+            json.dumps(meta, ensure_ascii=False), time.time()
+        ))
+
+    overflow = len(messages) - HISTORY_MEMORY_LIMIT
+    if overflow > 0:
+        rendered = st.session_state.get("rendered_html", {})
+        for old in messages[:overflow]:
+            rendered.pop(old["id"], None)
+        del messages[:overflow]
+        # 불러온 이전 기록과 이어지지 않게 되므로 비우고 다시 불러오도록 함
+        st.session_state.archived_messages = []
+        st.session_state.history_visible = min(st.session_state.get("history_visible", HISTORY_PAGE_SIZE), HISTORY_MEMORY_LIMIT)
+
+# 부모님 질문 기록 함수
+def append_user_message(content):
+    append_message({"role": "user", "content": content})
+
+# 챗봇 응답 기록 함수
+def append_bot_message(content, triage=None):
+    """응답과 함께 첫 토큰 지연시간, 이미지 전처리 통계, 선택된 모델, 프롬프트 캐시 적중률, 응급 신호 분류 결과를 기록"""
+    append_message({
+        "role": "bot",
+        "content": content,
+        "ttft": st.session_state.get("last_ttft"),
+        "image_stats": st.session_state.get("last_image_stats"),
+        "cached": st.session_state.get("last_cache_hit", False),
+        "similarity": st.session_state.get("last_similarity"),
+        "prompt_tokens": st.session_state.get("last_prompt_tokens"),
+        "route": st.session_state.get("last_route"),
+        "latency": st.session_state.get("last_latency"),
+        "cached_ratio": st.session_state.get("last_cached_ratio"),
+        "triage": triage if triage and triage["level"] else None
+    })
+
+# 이미지 전처리 통계 문구 생성 함수
+def format_image_stats(stats):
+    """사진 한 장이면 크기·detail까지, 여러 장이면 합계와 장별 detail을 표시"""
+    stats = [stats] if isinstance(stats, dict) else stats
+    original_bytes = sum(item["original_bytes"] for item in stats)
+    encoded_bytes = sum(item["encoded_bytes"] for item in stats)
+    saved_ratio = (original_bytes - encoded_bytes) / original_bytes * 100 if original_bytes else 0
+    change = f"{saved_ratio:.0f}% 절감" if saved_ratio >= 0 else f"{-saved_ratio:.0f}% 증가"
+    tokens = sum(item["estimated_tokens"] for item in stats)
+    if len(stats) == 1:
+        details = f"{stats[0]['width']}×{stats[0]['height']}, detail={stats[0]['detail']}"
+        label = "이미지"
+    else:
+        details = "detail=" + "/".join(item["detail"] for item in stats)
+        label = f"사진 {len(stats)}장"
+    return (f"🖼️ {label} {original_bytes / 1024:,.0f}KB → {encoded_bytes / 1024:,.0f}KB "
+            f"({change}, {details}, 예상 이미지 토큰 {tokens:,})")
+
 # API 키 입력 폼
 def show_api_key_form():
     st.markdown('<div class="api-form">', unsafe_allow_html=True)
@@ -384,6 +2370,10 @@ def show_api_key_form():
     
     if st.button("🔑 인증하기", type="primary", use_container_width=True):
         is_valid, message = validate_api_key(api_key)
+        if is_valid:
+            # 형식이 맞으면 실제로 쓸 수 있는 키인지 한 번 확인 (결과는 키 해시별로 캐시)
+            with st.spinner("🔑 API 키를 확인하는 중입니다..."):
+                is_valid, message = probe_api_key(api_key)
         if is_valid:
             st.session_state.api_key = api_key
             st.session_state.authenticated = True
@@ -395,9 +2385,135 @@ def show_api_key_form():
     
     st.markdown('</div>', unsafe_allow_html=True)
 
+# 상담 기록 한 화면에 보여줄 메시지 수
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "20"))
+
+# 메시지 HTML 생성 함수 (메시지 id별로 한 번만 생성)
+def render_message_html(msg):
+    rendered = st.session_state.setdefault("rendered_html", {})
+    html = rendered.get(msg["id"])
+    if html is None:
+        if msg["role"] == "user":
+            html = f'<div class="chat-message user"><strong>👨‍👩‍👧‍👦 부모님:</strong><br>{msg["content"]}</div>'
+        else:
+            html = render_bot_bubble(msg["content"])
+        rendered[msg["id"]] = html
+    return html
+
+# 이전 대화 더 보기 콜백
+def show_more_history():
+    """세션에 없는 이전 메시지는 저장소에서 한 페이지씩 읽어 앞에 붙임"""
+    visible = st.session_state.get("history_visible", HISTORY_PAGE_SIZE) + HISTORY_PAGE_SIZE
+    st.session_state.history_visible = visible
+    archived = st.session_state.get("archived_messages", [])
+    loaded = archived + st.session_state.messages
+    store = _consultation_store()
+    if store and loaded and loaded[0]["seq"] > 0 and visible > len(loaded):
+        older = store.load_messages(st.session_state.session_id, loaded[0]["seq"], visible - len(loaded))
+        st.session_state.archived_messages = older + archived
+
+# 화면에 아직 표시하지 않은 이전 메시지 수
+def hidden_history_count(loaded, start):
+    stored = loaded[0]["seq"] if loaded and _consultation_store() else 0
+    return start + stored
+
+# 이메일 복사용 본문 생성 함수 (말풍선 줄바꿈 태그를 일반 줄바꿈으로)
+def copy_box_text(content):
+    return content.replace('<br>', '\n').replace('</br>', '\n')
+
+# 피드백·복사 위젯 (클릭해도 이 영역만 다시 실행)
+@st.fragment
+def render_message_actions(msg):
+    feedback_cols = st.columns([1, 1, 8])
+    with feedback_cols[0]:
+        if st.button("👍", key=f"good_{msg['id']}", help="도움이 되었어요"):
+            save_feedback(msg['id'], "좋아요")
+    with feedback_cols[1]:
+        if st.button("👎", key=f"bad_{msg['id']}", help="별로였어요"):
+            save_feedback(msg['id'], "별로에요")
+
+    with feedback_cols[2]:
+        with st.expander("📋 이메일 내용 복사하기"):
+            st.text_area(
+                label="아래 내용을 복사하여 이메일에 붙여넣으세요.",
+                value=copy_box_text(msg['content']),
+                height=250,
+                key=f"copy_{msg['id']}"
+            )
+
+# 상담 기록 렌더링 (최근 메시지부터 페이지 단위로 표시)
+@st.fragment
+def render_chat_history():
+    """기록 길이와 관계없이 최근 HISTORY_PAGE_SIZE개씩만 그려 재실행 시간을 일정하게 유지"""
+    messages = st.session_state.get("archived_messages", []) + st.session_state.messages
+    visible = st.session_state.get("history_visible", HISTORY_PAGE_SIZE)
+    start = max(0, len(messages) - visible)
+    hidden = hidden_history_count(messages, start)
+    if hidden:
+        st.button(f"⬆️ 이전 대화 더 보기 ({hidden}개)", on_click=show_more_history, use_container_width=True)
+    for msg in messages[start:]:
+        st.markdown(render_message_html(msg), unsafe_allow_html=True)
+        if msg["role"] == "user":
+            continue
+        if msg.get("triage"):
+            render_triage_alert(msg["triage"])
+        if msg.get("similarity") is not None:
+            st.caption(f"🔎 비슷한 질문에 대한 저장된 답변입니다 (유사도 {msg['similarity']:.2f}).")
+        elif msg.get("cached"):
+            st.caption("💾 저장된 답변을 바로 보여드렸습니다.")
+        if msg.get("ttft") is not None:
+            st.caption(f"⚡ 첫 응답까지 {msg['ttft']:.2f}초")
+        if msg.get("route") and not msg.get("cached"):
+            route = msg["route"]
+            st.caption(f"🧭 {route['model']} · 최대 {route['max_tokens']:,}토큰 ({route['label']})")
+        if msg.get("image_stats"):
+            st.caption(format_image_stats(msg["image_stats"]))
+        if msg.get("prompt_tokens") is not None:
+            caption = f"📏 프롬프트 약 {msg['prompt_tokens']:,}토큰 (예산 {CONTEXT_TOKEN_BUDGET:,})"
+            if msg.get("cached_ratio") is not None:
+                caption += f" · ♻️ 프롬프트 캐시 적중 {msg['cached_ratio']:.0%}"
+            st.caption(caption)
+        render_message_actions(msg)
+
+# 운영 지표 패널 (METRICS_ADMIN_PANEL=1일 때 사이드바에 표시)
+def render_metrics_panel():
+    metrics = _metrics_store()
+    with metrics.lock:
+        rows = [
+            {
+                "지표": name.removeprefix("chatbot_"),
+                "라벨": ", ".join(f"{k}={v}" for k, v in labels),
+                "건수": histogram.count,
+                "평균": round(histogram.sum / histogram.count, 3) if histogram.count else None,
+                "p50": round(histogram.quantile(0.5), 3) if histogram.count else None,
+                "p95": round(histogram.quantile(0.95), 3) if histogram.count else None
+            }
+            for (name, labels), histogram in sorted(metrics.histograms.items())
+        ]
+        counters = dict(metrics.counters)
+    tokens = {kind: sum(v for (name, labels), v in counters.items() if name == "chatbot_tokens_total" and ("type", kind) in labels) for kind in ("prompt", "cached", "completion")}
+    cost = sum(v for (name, _), v in counters.items() if name == "chatbot_cost_usd_total")
+    with st.expander("📊 운영 지표"):
+        prompt_total = tokens['prompt'] + tokens['cached']
+        cached_share = tokens['cached'] / prompt_total if prompt_total else 0
+        st.caption(f"입력 {prompt_total:,.0f}토큰 (캐시 적중 {tokens['cached']:,.0f}, {cached_share:.0%}) · 출력 {tokens['completion']:,.0f}토큰 · 예상 비용 ${cost:,.4f}")
+        if rows:
+            st.dataframe(rows, hide_index=True, use_container_width=True)
+        else:
+            st.caption("아직 기록된 요청이 없습니다.")
+
 # 메인 애플리케이션
 def main():
+    # 페이지 설정 (배치 실행기 등에서 모듈을 가져올 때는 실행되지 않도록 main에서 호출)
+    st.set_page_config(
+        page_title="어린이 건강 챗봇",
+        page_icon="👶",
+        layout="wide",
+        initial_sidebar_state="expanded"
+    )
     apply_custom_css()
+    if METRICS_PORT:
+        _metrics_server()
     
     if "authenticated" not in st.session_state:
         st.session_state.authenticated = False
@@ -405,7 +2521,25 @@ def main():
         st.session_state.api_key = ""
     if "messages" not in st.session_state:
         st.session_state.messages = []
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    if "streaming" not in st.session_state:
+        st.session_state.streaming = True
+    if "use_cache" not in st.session_state:
+        st.session_state.use_cache = True
+    if "context_summary" not in st.session_state:
+        st.session_state.context_summary = {"text": "", "upto": 0}
+    # 백그라운드에서 끝난 대화 요약은 다음 요청을 만들기 전에 반영
+    apply_context_summary()
     
+    if not st.session_state.authenticated and API_KEY_MODE == "server":
+        api_key = assign_server_api_key()
+        if api_key is None:
+            st.error("⚠️ 서버에 사용할 수 있는 OpenAI API 키가 설정되어 있지 않습니다. 관리자에게 문의해주세요.")
+            return
+        st.session_state.api_key = api_key
+        st.session_state.authenticated = True
+
     if not st.session_state.authenticated:
         show_api_key_form()
         return
@@ -414,11 +2548,41 @@ def main():
         st.title("👶 어린이 건강 챗봇")
         st.markdown("---")
         st.markdown("### 🔐 API 상태")
-        st.success("✅ API 인증 완료")
-        if st.button("🔑 API 키 재설정", use_container_width=True):
-            st.session_state.authenticated = False
-            st.session_state.api_key = ""
-            st.rerun()
+        if API_KEY_MODE == "server":
+            st.success("✅ 서비스 API 키 사용 중")
+            used = session_quota_usage()
+            limits = []
+            if SESSION_REQUEST_QUOTA:
+                limits.append(f"요청 {max(0, SESSION_REQUEST_QUOTA - used['requests'])}회")
+            if SESSION_TOKEN_QUOTA:
+                limits.append(f"{max(0, SESSION_TOKEN_QUOTA - used['tokens']):,}토큰")
+            if limits:
+                st.caption(f"이번 접속에서 남은 사용량: {' · '.join(limits)}")
+        else:
+            st.success("✅ API 인증 완료")
+            if st.button("🔑 API 키 재설정", use_container_width=True):
+                st.session_state.authenticated = False
+                st.session_state.api_key = ""
+                st.rerun()
+        
+        st.markdown("---")
+        st.markdown("### ⚙️ 응답 설정")
+        st.toggle("⚡ 실시간 답변 표시 (스트리밍)", key="streaming", help="답변이 생성되는 대로 바로 보여줍니다.")
+        st.toggle("💾 같은 질문은 저장된 답변 사용", key="use_cache", help="끄면 항상 새로 답변을 생성합니다.")
+        st.selectbox(
+            "🧭 답변 모델",
+            ["자동", *ROUTABLE_MODELS],
+            key="model_override",
+            help="자동이면 질문 길이, 사진 첨부, 응급 신호, 추가 질문 여부에 따라 모델과 답변 길이를 고릅니다.",
+            disabled=bool(MODEL_OVERRIDE)
+        )
+        queue_length = _request_scheduler().queue_length()
+        if queue_length:
+            st.caption(f"⏳ 현재 대기 중인 요청 {queue_length}건")
+        cache_stats = response_cache_stats()
+        st.caption(f"캐시 적중 {cache_stats['hits']}회 · 미적중 {cache_stats['misses']}회 · 저장 {cache_stats['size']}건")
+        if METRICS_ADMIN_PANEL:
+            render_metrics_panel()
         
         st.markdown("---")
         st.markdown("### 📖 사용 방법")
@@ -429,68 +2593,84 @@ def main():
         st.warning("이 서비스는 참고용이며, 정확한 진단은 반드시 전문 의료진의 진료를 받아야 합니다.")
         
         if st.button("🗑️ 대화 초기화", use_container_width=True):
+            # 아직 진행 중인 요청이 있으면 취소
+            if st.session_state.get("inflight_cancel"):
+                st.session_state.inflight_cancel.set()
             st.session_state.messages = []
+            st.session_state.archived_messages = []
+            # 저장소에서는 새 대화로 구분
+            st.session_state.session_id = uuid.uuid4().hex
+            st.session_state.message_seq = 0
+            st.session_state.context_summary = {"text": "", "upto": 0}
+            st.session_state.rendered_html = {}
+            st.session_state.history_visible = HISTORY_PAGE_SIZE
             st.rerun()
     
     st.title("👶 어린이 건강 상담 챗봇")
     st.markdown("아이의 증상을 텍스트로 설명하거나, **사진만 첨부해도 자동으로 분석**해드립니다!")
     
     symptoms = st.text_area("아이의 증상을 자세히 입력해주세요 (선택사항):", height=120, placeholder="예: 아이가 39도 열이 나고 기침을 합니다...")
-    uploaded_file = st.file_uploader("📸 사진 첨부 (피부 발진, 상처 등)", type=["jpg", "jpeg", "png"])
+    uploaded_files = st.file_uploader(
+        "📸 사진 첨부 (피부 발진, 상처 등 · 여러 각도나 전후 비교 사진은 여러 장 가능)",
+        type=["jpg", "jpeg", "png"],
+        accept_multiple_files=True
+    )
+    if len(uploaded_files) > MAX_UPLOAD_IMAGES:
+        st.warning(f"⚠️ 사진은 한 번에 {MAX_UPLOAD_IMAGES}장까지 분석합니다. 앞의 {MAX_UPLOAD_IMAGES}장만 사용합니다.")
+        uploaded_files = uploaded_files[:MAX_UPLOAD_IMAGES]
     
-    if uploaded_file:
-        st.image(uploaded_file, caption="첨부된 사진", width=200)
+    if uploaded_files:
+        # 썸네일은 사진 내용별로 한 번만 만들어 재실행마다 원본을 다시 디코딩하지 않음
+        thumbnails = [image_thumbnail(image_hash, f) for image_hash, f in zip(image_content_hashes(uploaded_files), uploaded_files)]
+        st.image(thumbnails, caption=[f"첨부된 사진 {i}" for i in range(1, len(thumbnails) + 1)], width=THUMBNAIL_EDGE)
+        st.checkbox("📸 종합 상담과 함께 이미지 정밀 분석도 받기 (동시에 요청)", key="combined_mode")
 
     col1, col2 = st.columns(2)
     with col1:
         if st.button("🩺 종합 상담 받기", type="primary", use_container_width=True):
-            if symptoms.strip() or uploaded_file:
+            quota_message = session_quota_message()
+            if (symptoms.strip() or uploaded_files) and quota_message:
+                # 한도를 넘어도 응급 신호 안내는 모델 호출 없이 보여줌
+                triage = triage_symptoms(symptoms)
+                if triage["level"]:
+                    render_triage_alert(triage)
+                st.warning(quota_message)
+            elif symptoms.strip() or uploaded_files:
                 user_message = symptoms if symptoms.strip() else "이미지를 첨부했습니다."
-                st.session_state.messages.append({"role": "user", "content": user_message})
+                append_user_message(user_message)
+                # 위험 신호는 모델 응답을 기다리지 않고 바로 안내
+                triage = triage_symptoms(symptoms)
+                if triage["level"]:
+                    render_triage_alert(triage)
                 with st.spinner("🤖 전문가가 상담 내용을 분석 중입니다..."):
-                    bot_response = get_medical_advice(symptoms, uploaded_file)
-                    st.session_state.messages.append({"role": "bot", "content": bot_response, "id": f"bot_{len(st.session_state.messages)}"})
+                    if symptoms.strip() and uploaded_files and st.session_state.get("combined_mode"):
+                        bot_response = get_combined_advice(symptoms, uploaded_files, use_cache=st.session_state.use_cache, history=st.session_state.messages[:-1])
+                    else:
+                        bot_response = get_medical_advice(symptoms, uploaded_files, use_cache=st.session_state.use_cache, history=st.session_state.messages[:-1])
+                    append_bot_message(bot_response, triage)
+                    update_context_summary(st.session_state.messages)
                 st.rerun()
             else:
                 st.warning("⚠️ 증상을 입력하거나 사진을 첨부해주세요.")
 
     with col2:
         if st.button("📸 이미지만 분석하기", use_container_width=True):
-            if uploaded_file:
-                st.session_state.messages.append({"role": "user", "content": "이미지 분석을 요청했습니다."})
+            quota_message = session_quota_message()
+            if uploaded_files and quota_message:
+                st.warning(quota_message)
+            elif uploaded_files:
+                append_user_message("이미지 분석을 요청했습니다.")
                 with st.spinner("📸 이미지를 정밀 분석 중입니다..."):
-                    bot_response = analyze_medical_image(uploaded_file)
-                    st.session_state.messages.append({"role": "bot", "content": bot_response, "id": f"bot_{len(st.session_state.messages)}"})
+                    bot_response = analyze_medical_image(uploaded_files, use_cache=st.session_state.use_cache)
+                    append_bot_message(bot_response)
+                    update_context_summary(st.session_state.messages)
                 st.rerun()
             else:
                 st.warning("📸 먼저 분석할 사진을 첨부해주세요.")
 
     if st.session_state.messages:
         st.markdown("--- \n### 💬 상담 기록")
-        for i, msg in enumerate(st.session_state.messages):
-            if msg["role"] == "user":
-                st.markdown(f'<div class="chat-message user"><strong>👨‍👩‍👧‍👦 부모님:</strong><br>{msg["content"]}</div>', unsafe_allow_html=True)
-            else:
-                st.markdown(f'<div class="chat-message bot"><strong>🩺 챗봇 상담:</strong><br>{msg["content"]}</div>', unsafe_allow_html=True)
-                
-                # --- 수정된 부분: 피드백 및 내용 복사 기능 ---
-                feedback_cols = st.columns([1, 1, 8])
-                with feedback_cols[0]:
-                    if st.button("👍", key=f"good_{msg['id']}", help="도움이 되었어요"):
-                        save_feedback(msg['id'], "좋아요")
-                with feedback_cols[1]:
-                    if st.button("👎", key=f"bad_{msg['id']}", help="별로였어요"):
-                        save_feedback(msg['id'], "별로에요")
-
-                with feedback_cols[2]:
-                    with st.expander("📋 이메일 내용 복사하기"):
-                        clean_content = msg['content'].replace('<br>', '\n').replace('</br>', '\n')
-                        st.text_area(
-                            label="아래 내용을 복사하여 이메일에 붙여넣으세요.",
-                            value=clean_content,
-                            height=250,
-                            key=f"copy_{msg['id']}"
-                        )
+        render_chat_history()
 
     else:
         # --- 수정된 부분: 첫 방문 안내 메시지 ---